@@ -8,10 +8,26 @@ class Settings(BaseSettings):
     # Bot settings
     BOT_TOKEN: str
     OPENROUTER_API_KEY: str
+    OPENAI_API_KEY: Optional[str] = None  # Only needed for Batch API jobs
+    AI_BATCH_MODEL: str = "gpt-4o-mini"  # OpenAI model name (no provider prefix) for Batch API jobs
     ADMIN_USER_ID: int
+    TELEGRAM_CONNECTION_LIMIT: int = 500
 
     # Database
     DATABASE_URL: str
+    DB_POOL_SIZE: int = 20  # Connections opened at startup and kept in the pool
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_PRE_PING: bool = True  # Disable on a stable network to skip a ping per checkout
+
+    # Column compression for large text columns (PG14+): "lz4" or "pglz"
+    DB_COLUMN_COMPRESSION: Optional[str] = None
+    # Buffered last_activity timestamps are written to the DB at this interval
+    ACTIVITY_FLUSH_INTERVAL_SECONDS: int = 5
+    # Generated content is inserted into content_history in batches at this interval
+    CONTENT_HISTORY_FLUSH_INTERVAL_SECONDS: int = 2
+    # Users looked up by telegram_id are reused from memory for this long
+    USER_CACHE_TTL_SECONDS: int = 30
+    USER_CACHE_MAX_ENTRIES: int = 10000
 
     # Redis (optional)
     REDIS_URL: Optional[str] = None
@@ -28,8 +44,26 @@ class Settings(BaseSettings):
     # Payment settings
     ZARINPAL_MERCHANT_ID: Optional[str] = None
 
+    # AI settings
+    AI_MODEL: str = "openai/gpt-4o-mini"
+    AI_FAST_MODEL: str = "openai/gpt-4o-mini"  # Captions and content calendar
+    AI_MAX_CONCURRENCY: int = 10  # Simultaneous OpenRouter requests per process
+    AI_CACHE_TTL_SECONDS: int = 3600
+    AI_CACHE_MAX_ENTRIES: int = 2000
+    AI_REDIS_CACHE_TTL_SECONDS: int = 14400  # Used when REDIS_URL is set
+    AI_SEMANTIC_CACHE_ENABLED: bool = False  # Reuse answers for paraphrased captions/visual ideas
+    AI_SEMANTIC_CACHE_MODEL: str = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+    AI_SEMANTIC_CACHE_MAX_DISTANCE: float = 0.15  # Cosine distance
+    AI_SEMANTIC_CACHE_MAX_ENTRIES: int = 10000
+    AI_SEMANTIC_CACHE_PATH: Optional[str] = None  # Persisted on shutdown when set
+
     # Speech-to-text settings
     WHISPER_MODEL_NAME: str = "vhdm/whisper-large-fa-v1"
+    WHISPER_BACKEND: str = "transformers"  # or "faster-whisper" (CTranslate2)
+    WHISPER_CT2_MODEL_PATH: Optional[str] = None  # CTranslate2 conversion of WHISPER_MODEL_NAME
+    WHISPER_BATCH_SIZE: int = 8  # Voice notes transcribed together in one forward pass
+    WHISPER_BATCH_WINDOW_MS: int = 50  # How long to wait for more notes to join a batch
+    WHISPER_PRELOAD: bool = True  # Load and warm the model at startup instead of on first use
     AUDIO_MAX_FILE_SIZE_MB: int = 20
     AUDIO_MAX_DURATION_SECONDS: int = 300  # 5 minutes
     AUDIO_CACHE_DIR: Optional[str] = None
@@ -42,6 +76,29 @@ class Settings(BaseSettings):
             raise ValueError(f'Log level must be one of {valid_levels}')
         return level
 
+    @field_validator("WHISPER_BACKEND")
+    def validate_whisper_backend(cls, v: str) -> str:
+        backend = v.lower()
+        if backend not in ('transformers', 'faster-whisper'):
+            raise ValueError('Whisper backend must be transformers or faster-whisper')
+        return backend
+
+    @field_validator("AI_BATCH_MODEL")
+    def validate_batch_model(cls, v: str) -> str:
+        # Batch jobs go straight to OpenAI, which knows no OpenRouter provider prefixes
+        if "/" in v:
+            raise ValueError('AI batch model must be an OpenAI model name such as gpt-4o-mini')
+        return v
+
+    @field_validator("DB_COLUMN_COMPRESSION")
+    def validate_column_compression(cls, v: Optional[str]) -> Optional[str]:
+        if v is None:
+            return v
+        method = v.lower()
+        if method not in ('lz4', 'pglz'):
+            raise ValueError('Column compression must be lz4 or pglz')
+        return method
+
     class Config:
         env_file = ".env"
         case_sensitive = True
@@ -1,9 +1,22 @@
+import asyncio
 import logging
+from typing import Optional
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import DeclarativeBase
 
 logger = logging.getLogger(__name__)
 
+# Large text columns that are worth compressing when stored out of line (TOAST)
+COMPRESSED_COLUMNS = (
+    ("content_history", "generated_content"),
+    ("user_profiles", "situation_summary"),
+    ("user_profiles", "additional_info"),
+    ("prompt_templates", "content"),
+)
+# pg_attribute.attcompression codes for each method
+_COMPRESSION_CODES = {"pglz": "p", "lz4": "l"}
+
 class Base(DeclarativeBase):
     pass
 
@@ -11,18 +24,22 @@ class Database:
     """
     Manages the database engine and session factory.
     """
-    def __init__(self, url: str):
+    def __init__(self, url: str, pool_size: int = 20, max_overflow: int = 10, pool_pre_ping: bool = True):
         """
         Initializes the database engine and session factory with production-ready settings.
         :param url: The database connection URL.
+        :param pool_size: Connections kept open in the pool.
+        :param max_overflow: Extra connections allowed above pool_size under load.
+        :param pool_pre_ping: Check each connection with a ping on checkout.
         """
+        self.pool_size = pool_size
         self.engine = create_async_engine(
             url,
             echo=False,  # Set to True for debugging SQL queries
-            pool_size=20,
-            max_overflow=10,
-            pool_pre_ping=True,
-            pool_recycle=300,  # Recycle connections every 5 minutes
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=pool_pre_ping,
+            pool_recycle=1800,  # Recycle connections every 30 minutes; pre_ping covers dropped ones
         )
         self.session_factory = async_sessionmaker(
             bind=self.engine,
@@ -31,8 +48,11 @@ class Database:
         )
         logger.info("Database engine and session factory initialized.")
 
-    async def create_tables(self):
-        """Creates all database tables defined in the Base metadata."""
+    async def create_tables(self, column_compression: Optional[str] = None):
+        """
+        Creates all database tables defined in the Base metadata.
+        :param column_compression: Optional TOAST compression method for large text columns.
+        """
         async with self.engine.begin() as conn:
             # Import all models here to ensure their metadata is registered on Base
             from models.schema import User, UserProfile, Subscription, ContentHistory
@@ -40,6 +60,117 @@ class Database:
             await conn.run_sync(Base.metadata.create_all)
         logger.info("Database tables created or already exist.")
 
+        # create_all doesn't alter existing tables, so older databases are upgraded here
+        await self.add_prompt_usage_constraint()
+        await self.add_prompt_template_column()
+
+        if column_compression:
+            await self.set_column_compression(column_compression)
+
+    async def add_prompt_usage_constraint(self):
+        """
+        Adds the (user_id, prompt_name) unique constraint that prompt usage upserts rely
+        on to a prompt_history table created without it. Duplicate rows are merged first
+        into the newest one, with their usage counts summed. Once the constraint exists
+        only the catalog is read, so no lock is taken on later startups.
+        """
+        try:
+            async with self.engine.begin() as conn:
+                if await conn.scalar(text(
+                    "SELECT 1 FROM pg_constraint WHERE conname = 'uq_prompt_user_name'"
+                )):
+                    return
+                await conn.execute(text(
+                    "UPDATE prompt_history h SET usage_count = d.total "
+                    "FROM (SELECT max(id) AS id, sum(coalesce(usage_count, 1)) AS total "
+                    "FROM prompt_history GROUP BY user_id, prompt_name HAVING count(*) > 1) d "
+                    "WHERE h.id = d.id"
+                ))
+                await conn.execute(text(
+                    "DELETE FROM prompt_history a USING prompt_history b "
+                    "WHERE a.user_id = b.user_id AND a.prompt_name = b.prompt_name AND a.id < b.id"
+                ))
+                await conn.execute(text(
+                    "ALTER TABLE prompt_history "
+                    "ADD CONSTRAINT uq_prompt_user_name UNIQUE (user_id, prompt_name)"
+                ))
+                # The constraint's index replaces the old composite one
+                await conn.execute(text("DROP INDEX IF EXISTS ix_prompt_history_user_name"))
+            logger.info("Unique constraint uq_prompt_user_name added to prompt_history.")
+        except Exception as e:
+            logger.error(f"Could not add unique constraint to prompt_history: {e}")
+
+    async def add_prompt_template_column(self):
+        """
+        Adds the nullable prompt_template_id foreign key to a prompt_history table created
+        without it. Existing rows keep their full prompt text in prompt_content and
+        reference no template. Once the column exists only the catalog is read.
+        """
+        try:
+            async with self.engine.begin() as conn:
+                if await conn.scalar(text(
+                    "SELECT 1 FROM information_schema.columns "
+                    "WHERE table_schema = current_schema() AND table_name = 'prompt_history' "
+                    "AND column_name = 'prompt_template_id'"
+                )):
+                    return
+                await conn.execute(text(
+                    "ALTER TABLE prompt_history "
+                    "ADD COLUMN prompt_template_id INTEGER REFERENCES prompt_templates(id)"
+                ))
+            logger.info("Column prompt_template_id added to prompt_history.")
+        except Exception as e:
+            logger.error(f"Could not add prompt_template_id to prompt_history: {e}")
+
+    async def set_column_compression(self, method: str):
+        """
+        Sets the TOAST compression method on the large text columns.
+        Only newly written values are compressed with it; requires PostgreSQL 14+.
+        Columns already using the method are left alone, so a restart takes no
+        ACCESS EXCLUSIVE lock once the setting has been applied.
+        """
+        try:
+            async with self.engine.begin() as conn:
+                rows = await conn.execute(text(
+                    "SELECT c.relname, a.attname FROM pg_attribute a "
+                    "JOIN pg_class c ON c.oid = a.attrelid "
+                    "WHERE c.relkind = 'r' AND pg_table_is_visible(c.oid) "
+                    "AND a.attcompression = :code "
+                    "AND (c.relname, a.attname) IN ("
+                    + ", ".join(f"('{table}', '{column}')" for table, column in COMPRESSED_COLUMNS)
+                    + ")"
+                ), {"code": _COMPRESSION_CODES[method]})
+                current = {(row.relname, row.attname) for row in rows}
+                pending = [pair for pair in COMPRESSED_COLUMNS if pair not in current]
+                for table, column in pending:
+                    await conn.execute(text(
+                        f"ALTER TABLE {table} ALTER COLUMN {column} SET COMPRESSION {method}"
+                    ))
+            if pending:
+                logger.info(f"Column compression set to {method} on {len(pending)} column(s).")
+            else:
+                logger.info(f"Column compression already {method}.")
+        except Exception as e:
+            logger.warning(f"Could not set column compression to {method}: {e}")
+
+    async def prewarm(self):
+        """
+        Opens pool_size connections at once and returns them to the pool, so the first
+        concurrent updates don't each pay for connection setup.
+        """
+        # All connections are held until every one is open, so none is reused
+        results = await asyncio.gather(
+            *(self.engine.connect().start() for _ in range(self.pool_size)),
+            return_exceptions=True
+        )
+        connections = [result for result in results if not isinstance(result, BaseException)]
+        await asyncio.gather(*(connection.close() for connection in connections))
+        if len(connections) < self.pool_size:
+            error = next(result for result in results if isinstance(result, BaseException))
+            logger.warning(f"Database pool prewarmed with {len(connections)}/{self.pool_size} connections: {error}")
+        else:
+            logger.info(f"Database pool prewarmed with {self.pool_size} connections.")
+
     def get_session_factory(self) -> async_sessionmaker[AsyncSession]:
         """
         Returns the configured session factory.
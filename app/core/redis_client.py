@@ -0,0 +1,31 @@
+import logging
+from typing import Optional
+
+from redis.asyncio import Redis
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+_redis: Optional[Redis] = None
+
+
+def get_redis() -> Optional[Redis]:
+    """
+    Returns the shared Redis client, or None when REDIS_URL is not configured.
+    The client is created on first use; connections are opened lazily by its pool.
+    """
+    global _redis
+    if _redis is None and settings.REDIS_URL:
+        _redis = Redis.from_url(settings.REDIS_URL, decode_responses=True)
+        logger.info("Redis client initialized.")
+    return _redis
+
+
+async def close_redis() -> None:
+    """Closes the shared Redis client and its connection pool."""
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+        logger.info("Redis connection pool closed.")
@@ -7,7 +7,7 @@ import logging
 import re
 
 from core.config import settings
-from services.ai_service import AIService
+from services.ai_service import AIService, ONBOARDING_REELS_THEME
 from services.user_service import UserService
 from services.speech_service import SpeechService
 from keyboards.builders import (
@@ -51,6 +51,29 @@ class DiscountStates(StatesGroup):
 # Create router
 router = Router()
 
+# Onboarding answers are staged in FSM state under these keys and written to the
+# users and user_profiles tables with one commit when their screen is done. A failed
+# write leaves them staged, so the next save retries them.
+_PENDING_USER_FIELDS = "pending_user_fields"
+_PENDING_PROFILE_FIELDS = "pending_profile_fields"
+
+async def _stage_answer(state: FSMContext, key: str, **fields) -> None:
+    """Add onboarding answers to the pending fields stored under key"""
+    pending = (await state.get_data()).get(key, {})
+    await state.update_data({key: {**pending, **fields}})
+
+async def _save_staged_answers(state: FSMContext, user_service: UserService, user_id: int) -> bool:
+    """Write the staged onboarding answers and clear them; they are kept if the write fails"""
+    data = await state.get_data()
+    user_fields = data.get(_PENDING_USER_FIELDS, {})
+    profile_fields = data.get(_PENDING_PROFILE_FIELDS, {})
+    if not user_fields and not profile_fields:
+        return True
+    if not await user_service.save_onboarding_answers(user_id, user_fields, profile_fields):
+        return False
+    await state.update_data({_PENDING_USER_FIELDS: {}, _PENDING_PROFILE_FIELDS: {}})
+    return True
+
 # Help command
 @router.message(Command("help"))
 async def cmd_help(message: Message):
@@ -97,7 +120,7 @@ async def cmd_start(message: Message, state: FSMContext, user_service: UserServi
         
         # Check if onboarding is completed
         if user.onboarding_completed:
-            subscription = await user_service.get_user_subscription(user.id)
+            subscription = user.subscription
             is_subscribed = subscription.is_active if subscription else False
             
             welcome_back = f"""
@@ -171,7 +194,10 @@ async def handle_name_input(message: Message, state: FSMContext, user_service: U
     
     try:
         user = await user_service.get_user_by_telegram_id(message.from_user.id)
-        await user_service.update_user_display_name(user.id, message.text)
+        await _stage_answer(state, _PENDING_USER_FIELDS, display_name=message.text)
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
         
         await message.answer(
             f"خیلی خوشحالم {message.text} جان! 😊\n\n"
@@ -208,7 +234,10 @@ async def handle_phone_input(message: Message, state: FSMContext, user_service:
     try:
         user = await user_service.get_user_by_telegram_id(message.from_user.id)
         if phone:
-            await user_service.update_user_phone(user.id, phone)
+            await _stage_answer(state, _PENDING_USER_FIELDS, phone=phone)
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
         
         await message.answer(
             "این مورد اختیاریه، اگه دوست داری مقاله‌های به‌روز برای تقویت طلافروشیت دریافت کنی، ایمیلت رو وارد کن:",
@@ -244,7 +273,10 @@ async def handle_email_input(message: Message, state: FSMContext, user_service:
     try:
         user = await user_service.get_user_by_telegram_id(message.from_user.id)
         if email:
-            await user_service.update_user_email(user.id, email)
+            await _stage_answer(state, _PENDING_USER_FIELDS, email=email)
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
         
         await message.answer(
             "خب حالا بریم سراغ چندتا سوال در مورد کسب‌وکارت، تا بتونم سناریو منحصربه‌فرد تو رو بهت بدم.\n\n"
@@ -268,7 +300,10 @@ async def handle_gallery_name(message: Message, state: FSMContext, user_service:
     
     try:
         user = await user_service.get_user_by_telegram_id(message.from_user.id)
-        await user_service.update_gallery_name(user.id, message.text)
+        await _stage_answer(state, _PENDING_PROFILE_FIELDS, gallery_name=message.text)
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
         
         await message.answer(
             f"گالری {message.text} 👌\n\n"
@@ -295,7 +330,10 @@ async def handle_instagram(message: Message, state: FSMContext, user_service: Us
         
         # Clean Instagram handle
         instagram = message.text.replace("@", "").replace("https://instagram.com/", "").strip()
-        await user_service.update_instagram_handle(user.id, instagram)
+        await _stage_answer(state, _PENDING_PROFILE_FIELDS, instagram_handle=instagram)
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
         
         await message.answer(
             "اگر کانال تلگرام هم داری بفرست یه چک بکنم:",
@@ -323,7 +361,10 @@ async def handle_telegram_channel(message: Message, state: FSMContext, user_serv
     try:
         user = await user_service.get_user_by_telegram_id(message.from_user.id)
         if telegram:
-            await user_service.update_telegram_channel(user.id, telegram)
+            await _stage_answer(state, _PENDING_PROFILE_FIELDS, telegram_channel=telegram)
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
         
         await message.answer(
             "بیشتر مشتریات کیا هستن؟\n\n"
@@ -347,7 +388,10 @@ async def handle_customers(message: Message, state: FSMContext, user_service: Us
     
     try:
         user = await user_service.get_user_by_telegram_id(message.from_user.id)
-        await user_service.update_main_customers(user.id, message.text)
+        await _stage_answer(state, _PENDING_PROFILE_FIELDS, main_customers=message.text)
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
         
         await message.answer(
             "چه باید و نبایدهایی رو باید برای سناریو تو رعایت کنم؟\n\n"
@@ -376,7 +420,10 @@ async def handle_constraints(message: Message, state: FSMContext, user_service:
     try:
         user = await user_service.get_user_by_telegram_id(message.from_user.id)
         if constraints:
-            await user_service.update_constraints(user.id, constraints)
+            await _stage_answer(state, _PENDING_PROFILE_FIELDS, constraints_and_guidelines=constraints)
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
         
         await message.answer(
             "کسیو داری که توی تولید محتوا کمکت کنه؟\n\n"
@@ -405,7 +452,10 @@ async def handle_content_help(message: Message, state: FSMContext, user_service:
     try:
         user = await user_service.get_user_by_telegram_id(message.from_user.id)
         if help_info:
-            await user_service.update_content_help(user.id, help_info)
+            await _stage_answer(state, _PENDING_PROFILE_FIELDS, content_help=help_info)
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
         
         await message.answer(
             "گالری حضوری هم داری یا نه هنوز؟",
@@ -430,7 +480,10 @@ async def handle_physical_store(message: Message, state: FSMContext, user_servic
     
     try:
         user = await user_service.get_user_by_telegram_id(message.from_user.id)
-        await user_service.update_physical_store(user.id, has_store)
+        await _stage_answer(state, _PENDING_PROFILE_FIELDS, has_physical_store=has_store)
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
         
         await message.answer(
             "حله، من هر سوالی داشتم پرسیدم، اگه فکر میکنی چیز خاصی هست که من باید بدونم ولی نپرسیدم بگو، وگرنه ادامه بدیم:",
@@ -453,10 +506,20 @@ async def handle_additional_info(message: Message, state: FSMContext, user_servi
     try:
         user = await user_service.get_user_by_telegram_id(message.from_user.id)
         if message.text and message.text not in ["ادامه بدیم", "رد کردن"]:
-            await user_service.update_additional_info(user.id, message.text)
-        profile = await user_service.get_user_profile(user.id)
+            await _stage_answer(state, _PENDING_PROFILE_FIELDS, additional_info=message.text)
+        # Written before the summary reads the profile. On failure the rollback has
+        # expired the profile, so it must not be read
+        if not await _save_staged_answers(state, user_service, user.id):
+            await message.answer("ذخیره پاسخ انجام نشد. لطفاً دوباره ارسال کنید.")
+            return
+        # Loaded with the user; the UPDATE above also refreshed it in the session
+        profile = user.profile
         ai = AIService()
-        summary = await ai.generate_situation_summary(profile)
+        # The onboarding reels are generated alongside the summary and kept in state
+        # for when the user confirms it
+        bundle = await ai.generate_onboarding_bundle(profile)
+        summary = bundle["summary"]
+        await state.update_data(onboarding_scenarios=bundle["scenarios"])
         await user_service.update_profile_summary_and_complete(user.id, summary, False)
         await message.answer(summary)
         await message.answer("آیا این خلاصه درست است؟", reply_markup=get_confirmation_keyboard())
@@ -485,8 +548,8 @@ async def handle_summary_confirmation(callback: CallbackQuery, state: FSMContext
         
         if approved:
             logger.info("User approved, getting profile...")
-            # Get user profile and ensure it exists
-            profile = await user_service.get_user_profile(user.id)
+            # Profile is loaded with the user; ensure it exists
+            profile = user.profile
             if not profile:
                 logger.info("Profile not found, creating one...")
                 # Create profile if it doesn't exist
@@ -496,15 +559,18 @@ async def handle_summary_confirmation(callback: CallbackQuery, state: FSMContext
             # Save summary and complete onboarding
             await user_service.approved_profile_summary(user.id, approved)
             
-            logger.info("Generating AI scenarios...")
-            # Generate 3 reels scenarios using AI
-            ai_service = AIService()
+            # Scenarios were generated together with the summary; generate them
+            # here only if the state no longer has them
+            scenarios = (await state.get_data()).get("onboarding_scenarios")
             try:
-                scenarios = await ai_service.generate_reels_scenario(
-                    theme="معرفی گالری طلا و جواهرات",
-                    user_profile=profile
-                )
-                logger.info("AI scenarios generated successfully")
+                if not scenarios:
+                    logger.info("Generating AI scenarios...")
+                    ai_service = AIService()
+                    scenarios = await ai_service.generate_reels_scenario(
+                        theme=ONBOARDING_REELS_THEME,
+                        user_profile=profile
+                    )
+                    logger.info("AI scenarios generated successfully")
             except Exception as e:
                 logger.error(f"Error generating scenarios: {e}")
                 scenarios = [
@@ -654,7 +720,7 @@ async def handle_goal_selection(callback: CallbackQuery, state: FSMContext, user
         )
         
         if success:
-            subscription = await user_service.get_user_subscription(user.id)
+            subscription = user.subscription
             is_subscribed = subscription.is_active if subscription else False
             
             success_text = f"""
@@ -692,7 +758,7 @@ async def handle_content_generation(message: Message, state: FSMContext, user_se
         user = await user_service.get_or_create_user(telegram_id=message.from_user.id)
         
         # Check subscription
-        subscription = await user_service.get_user_subscription(user.id)
+        subscription = user.subscription
         if not subscription or not subscription.is_active:
             await message.answer(
                 "برای استفاده از تولید محتوا، ابتدا باید اشتراک داشته باشید.",
@@ -714,7 +780,7 @@ async def handle_content_generation(message: Message, state: FSMContext, user_se
 async def handle_calendar_request(message: Message, state: FSMContext, user_service: UserService):
     try:
         user = await user_service.get_or_create_user(telegram_id=message.from_user.id)
-        profile = await user_service.get_user_profile(user.id)
+        profile = user.profile
         if not profile:
             await message.answer("لطفاً ابتدا پروفایل خود را تکمیل کنید. /profile")
             return
@@ -818,15 +884,14 @@ async def handle_visual_request(message: Message, state: FSMContext, user_servic
 # Content generation handlers
 # Voice support for content input states
 @router.message(F.voice, StateFilter(ContentGeneration.waiting_for_caption_input))
-async def handle_voice_caption_input(message: Message, state: FSMContext, user_service: UserService):
+async def handle_voice_caption_input(message: Message, state: FSMContext, user_service: UserService, speech_service: SpeechService):
     """Handle voice input for caption generation"""
     try:
         # Show processing message
         processing_msg = await message.answer("🎤 در حال تبدیل صدا به متن...")
 
-        # Initialize speech service
-        speech_service = SpeechService()
-
+        # The shared speech_service comes from the dispatcher, so the Whisper
+        # model is loaded once and reused across messages
         # Process voice message
         transcribed_text = await speech_service.process_voice_message(
             message.bot,
@@ -866,7 +931,7 @@ async def generate_captions(message: Message, state: FSMContext, user_service: U
     
     try:
         user = await user_service.get_or_create_user(telegram_id=message.from_user.id)
-        profile = await user_service.get_user_profile(user.id)
+        profile = user.profile
         
         if not profile:
             await message.answer("لطفاً ابتدا پروفایل خود را تکمیل کنید. /profile")
@@ -875,13 +940,19 @@ async def generate_captions(message: Message, state: FSMContext, user_service: U
         # Show loading message
         loading_msg = await message.answer("در حال تولید کپشن... ⏳")
         
-        # Generate captions
+        # Generate captions, showing each one as soon as it is ready
         ai_service = AIService()
-        captions = await ai_service.generate_caption(
+        captions = []
+        result_text = "🎯 کپشن‌های پیشنهادی:\n\n"
+        async for caption in ai_service.generate_caption_stream(
             product_description=message.text,
             user_profile=profile,
             from_voice=from_voice
-        )
+        ):
+            captions.append(caption)
+            result_text += f"کپشن {len(captions)}:\n{caption}\n\n---\n\n"
+            if len(captions) < 3:
+                await loading_msg.edit_text(result_text + "در حال تولید کپشن بعدی... ⏳")
         
         # Save to history
         captions_text = "\n\n---\n\n".join(captions)
@@ -893,13 +964,7 @@ async def generate_captions(message: Message, state: FSMContext, user_service: U
         )
         
         # Send results
-        await loading_msg.delete()
-        
-        result_text = "🎯 کپشن‌های پیشنهادی:\n\n"
-        for i, caption in enumerate(captions, 1):
-            result_text += f"کپشن {i}:\n{caption}\n\n---\n\n"
-        
-        await message.answer(result_text.strip())
+        await loading_msg.edit_text(result_text.strip())
         await message.answer(
             "کپشن‌ها آماده شد! ✅\nمی‌خواید محتوای دیگری تولید کنید؟",
             reply_markup=get_content_type_keyboard()
@@ -919,7 +984,7 @@ async def generate_reels_scenarios(message: Message, state: FSMContext, user_ser
     
     try:
         user = await user_service.get_or_create_user(telegram_id=message.from_user.id)
-        profile = await user_service.get_user_profile(user.id)
+        profile = user.profile
         
         if not profile:
             await message.answer("لطفاً ابتدا پروفایل خود را تکمیل کنید. /profile")
@@ -927,11 +992,18 @@ async def generate_reels_scenarios(message: Message, state: FSMContext, user_ser
         
         loading_msg = await message.answer("در حال تولید سناریو ریلز... 🎬")
         
+        # Scenarios are long, so each one is sent as its own message as soon as it is ready
         ai_service = AIService()
-        scenarios = await ai_service.generate_reels_scenario(
+        scenarios = []
+        async for scenario in ai_service.generate_reels_scenario_stream(
             theme=message.text,
             user_profile=profile
-        )
+        ):
+            scenarios.append(scenario)
+            if len(scenarios) == 1:
+                await loading_msg.edit_text(f"🎬 سناریوهای ریلز پیشنهادی:\n\n{scenario}")
+            else:
+                await message.answer(scenario)
         
         # Save to history
         scenarios_text = "\n\n---\n\n".join(scenarios)
@@ -942,13 +1014,6 @@ async def generate_reels_scenarios(message: Message, state: FSMContext, user_ser
             scenarios_text
         )
         
-        await loading_msg.delete()
-        
-        result_text = "🎬 سناریوهای ریلز پیشنهادی:\n\n"
-        for i, scenario in enumerate(scenarios, 1):
-            result_text += f"\n{scenario}\n\n---\n\n"
-        
-        await message.answer(result_text.strip())
         await message.answer(
             "سناریوها آماده شد! ✅\nمی‌خواید محتوای دیگری تولید کنید؟",
             reply_markup=get_content_type_keyboard()
@@ -968,7 +1033,7 @@ async def generate_visual_ideas(message: Message, state: FSMContext, user_servic
     
     try:
         user = await user_service.get_or_create_user(telegram_id=message.from_user.id)
-        profile = await user_service.get_user_profile(user.id)
+        profile = user.profile
         
         if not profile:
             await message.answer("لطفاً ابتدا پروفایل خود را تکمیل کنید. /profile")
@@ -976,11 +1041,23 @@ async def generate_visual_ideas(message: Message, state: FSMContext, user_servic
         
         loading_msg = await message.answer("در حال تولید ایده‌های بصری... 📷")
         
+        # Each idea is sent as its own message as soon as it is ready
         ai_service = AIService()
-        ideas = await ai_service.generate_visual_ideas(
+        ideas = []
+        async for idea in ai_service.generate_visual_ideas_stream(
             product_type=message.text,
             user_profile=profile
-        )
+        ):
+            ideas.append(idea)
+            formatted_idea = format_visual_idea_message(idea)
+            if len(ideas) == 1:
+                await loading_msg.edit_text(
+                    "📷 ایده‌های بصری پیشنهادی:\n\n"
+                    "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+                    f"{formatted_idea}"
+                )
+            else:
+                await message.answer(formatted_idea)
         
         # Save to history
         ideas_text = "\n\n---\n\n".join(ideas)
@@ -991,18 +1068,6 @@ async def generate_visual_ideas(message: Message, state: FSMContext, user_servic
             ideas_text
         )
         
-        await loading_msg.delete()
-        
-        result_text = "📷 ایده‌های بصری پیشنهادی:\n\n"
-        result_text += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        for i, idea in enumerate(ideas, 1):
-            formatted_idea = format_visual_idea_message(idea)
-            result_text += f"{formatted_idea}\n\n"
-            if i < len(ideas):
-                result_text += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        await message.answer(result_text.strip())
         await message.answer(
             "ایده‌ها آماده شد! ✅\nمی‌خواید محتوای دیگری تولید کنید؟",
             reply_markup=get_content_type_keyboard()
@@ -1019,7 +1084,7 @@ async def handle_subscription_renewal(message: Message, user_service: UserServic
     """Handle subscription renewal"""
     try:
         user = await user_service.get_or_create_user(telegram_id=message.from_user.id)
-        subscription = await user_service.get_user_subscription(user.id)
+        subscription = user.subscription
         
         if subscription and subscription.is_active:
             expiry_date = subscription.expires_at.strftime('%Y/%m/%d')
@@ -1092,13 +1157,13 @@ async def handle_payment_selection(callback: CallbackQuery):
 
 # Voice message handlers
 @router.message(F.voice)
-async def handle_voice_message(message: Message, state: FSMContext, user_service: UserService):
+async def handle_voice_message(message: Message, state: FSMContext, user_service: UserService, speech_service: SpeechService):
     """Handle voice message for speech-to-text conversion"""
     try:
         user = await user_service.get_or_create_user(telegram_id=message.from_user.id)
 
         # Check subscription
-        subscription = await user_service.get_user_subscription(user.id)
+        subscription = user.subscription
         if not subscription or not subscription.is_active:
             await message.answer(
                 "برای استفاده از قابلیت تبدیل صدا به متن، ابتدا باید اشتراک داشته باشید.",
@@ -1110,10 +1175,7 @@ async def handle_voice_message(message: Message, state: FSMContext, user_service
         processing_msg = await message.answer("🎤 در حال تبدیل صدا به متن...\nلطفاً کمی صبر کنید.")
 
         try:
-            # Initialize speech service
-            speech_service = SpeechService()
-
-            # Process voice message
+            # Process voice message with the shared speech_service
             transcribed_text = await speech_service.process_voice_message(
                 message.bot,
                 message.voice.file_id,
@@ -1191,7 +1253,7 @@ async def cancel_voice_transcription(callback: CallbackQuery, state: FSMContext,
     """Handle cancellation of voice transcription"""
     try:
         user = await user_service.get_or_create_user(telegram_id=callback.from_user.id)
-        subscription = await user_service.get_user_subscription(user.id)
+        subscription = user.subscription
         is_subscribed = subscription.is_active if subscription else False
 
         await callback.message.edit_text("عملیات لغو شد.")
@@ -1215,7 +1277,7 @@ async def back_to_main_menu(message: Message, state: FSMContext, user_service: U
         is_subscribed = False
         if user_service is not None:
             user = await user_service.get_or_create_user(telegram_id=message.from_user.id)
-            subscription = await user_service.get_user_subscription(user.id)
+            subscription = user.subscription
             is_subscribed = subscription.is_active if subscription else False
         
         await message.answer(
@@ -47,31 +47,26 @@ def get_discount_keyboard() -> ReplyKeyboardMarkup:
         input_field_placeholder="کد تخفیف را به صورت متن ارسال کنید..."
     )
 
+def _build_choice_markup(prefix: str, options) -> InlineKeyboardMarkup:
+    """Build an inline markup with two buttons per row for an enum of choices"""
+    buttons = [
+        InlineKeyboardButton(text=option.value, callback_data=f"{prefix}_{option.name.lower()}")
+        for option in options
+    ]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+# Profile setup keyboards never change, so they are built once at import time
+_PROFILE_SETUP_KEYBOARDS = {
+    "style": _build_choice_markup("style", PageStyle),
+    "audience": _build_choice_markup("audience", AudienceType),
+    "goal": _build_choice_markup("goal", SalesGoal),
+}
+_EMPTY_INLINE_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[])
+
 def get_profile_setup_keyboard(step: str) -> InlineKeyboardMarkup:
     """Profile setup keyboard based on step"""
-    builder = InlineKeyboardBuilder()
-    
-    if step == "style":
-        for style in PageStyle:
-            builder.add(InlineKeyboardButton(
-                text=style.value,
-                callback_data=f"style_{style.name.lower()}"
-            ))
-    elif step == "audience":
-        for audience in AudienceType:
-            builder.add(InlineKeyboardButton(
-                text=audience.value,
-                callback_data=f"audience_{audience.name.lower()}"
-            ))
-    elif step == "goal":
-        for goal in SalesGoal:
-            builder.add(InlineKeyboardButton(
-                text=goal.value,
-                callback_data=f"goal_{goal.name.lower()}"
-            ))
-    
-    builder.adjust(2)
-    return builder.as_markup()
+    return _PROFILE_SETUP_KEYBOARDS.get(step, _EMPTY_INLINE_KEYBOARD)
 
 def get_profile_edit_keyboard() -> ReplyKeyboardMarkup:
     """Profile editing keyboard"""
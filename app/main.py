@@ -1,18 +1,22 @@
 import asyncio
 import logging
 
+import orjson
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 
 from core.config import settings
 from core.db import Database
+from core.redis_client import close_redis
 from core.logging_setup import setup_logging
 from handlers.common import router as common_router
 from middlewares.db_middleware import DbSessionMiddleware
 from services.ai_service import AIService
 from services.speech_service import SpeechService
+from services.user_service import flush_activity, flush_content_history, run_flusher
 
 
 setup_logging(settings.LOG_LEVEL)
@@ -27,18 +31,36 @@ async def main() -> None:
     
     # 1. Initialize Database and Session Factory
     logger.info("Initializing database connection...")
-    db = Database(url=settings.DATABASE_URL)
-    await db.create_tables()
+    db = Database(
+        url=settings.DATABASE_URL,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_pre_ping=settings.DB_POOL_PRE_PING
+    )
+    await db.create_tables(column_compression=settings.DB_COLUMN_COMPRESSION)
+    await db.prewarm()
     session_maker: async_sessionmaker[AsyncSession] = db.session_factory
 
     # 2. Initialize Services (as singletons)
     logger.info("Initializing services...")
     ai_service = AIService()
     speech_service = SpeechService()
+    await ai_service.warmup()
+    if settings.WHISPER_PRELOAD:
+        await speech_service.warmup()
 
     # 3. Initialize Bot and Dispatcher
+    # A single aiohttp session (and connector) is shared by every outbound API call,
+    # with a higher connection limit than aiogram's default of 100. Updates and
+    # request bodies go through orjson instead of the stdlib json module.
+    session = AiohttpSession(
+        limit=settings.TELEGRAM_CONNECTION_LIMIT,
+        json_loads=orjson.loads,
+        json_dumps=lambda obj: orjson.dumps(obj).decode()
+    )
     bot = Bot(
         token=settings.BOT_TOKEN,
+        session=session,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
     dp = Dispatcher()
@@ -51,6 +73,17 @@ async def main() -> None:
     # All handlers from your 'handlers' package will be included.
     dp.include_router(common_router)
 
+    # Per-message last_activity updates and content history rows are buffered and
+    # written periodically
+    flushers = [
+        asyncio.create_task(
+            run_flusher(flush_activity, session_maker, settings.ACTIVITY_FLUSH_INTERVAL_SECONDS)
+        ),
+        asyncio.create_task(
+            run_flusher(flush_content_history, session_maker, settings.CONTENT_HISTORY_FLUSH_INTERVAL_SECONDS)
+        )
+    ]
+
     # 6. Start Polling
     # The 'ai_service' is passed here as a workflow data object, making it available
     # to all handlers and middlewares. The UserService will be created on-the-fly
@@ -63,6 +96,13 @@ async def main() -> None:
         # Graceful shutdown
         logger.info("Stopping bot and closing database connection...")
         await bot.session.close()
+        # Cancelling the flushers writes what is still buffered
+        for flusher in flushers:
+            flusher.cancel()
+        await asyncio.gather(*flushers, return_exceptions=True)
+        await AIService.aclose()
+        speech_service.close()
+        await close_redis()
         await db.close()
 
 if __name__ == "__main__":
@@ -23,7 +23,8 @@ class DbSessionMiddleware(BaseMiddleware):
 
         This method is called for every update. It creates a new session,
         initializes the UserService with that session, and passes both to the handler.
-        The session is automatically closed when the 'async with' block is exited.
+        Work left pending by the handler is committed on success and rolled back
+        on error, and the session is closed when the 'async with' block is exited.
         """
         import logging
         logger = logging.getLogger(__name__)
@@ -39,4 +40,11 @@ class DbSessionMiddleware(BaseMiddleware):
             logger.info(f"UserService created and added to data for event: {type(event).__name__}")
             
             # Call the next handler in the chain
-            return await handler(event, data)
\ No newline at end of file
+            try:
+                result = await handler(event, data)
+                if session.in_transaction():
+                    await session.commit()
+                return result
+            except Exception:
+                await session.rollback()
+                raise
\ No newline at end of file
@@ -1,11 +1,13 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Enum as SQLEnum, Float
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Enum as SQLEnum, Float, Index, UniqueConstraint, and_, or_, true, false
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from datetime import datetime, timedelta, timezone
 from enum import Enum
+from typing import Optional
 from core.db import Base
+import base64
 import secrets
-import string
 
 class PageStyle(str, Enum):
     SERIOUS = "جدی"
@@ -53,49 +55,55 @@ class OnboardingStep(str, Enum):
 
 class User(Base):
     __tablename__ = "users"
+    # Server-side defaults come back through RETURNING on INSERT, so a new row is
+    # fully loaded without a refresh
+    __mapper_args__ = {"eager_defaults": True}
     
     id = Column(Integer, primary_key=True)
     telegram_id = Column(Integer, unique=True, nullable=False, index=True)
-    username = Column(String(100), nullable=True)
+    username = Column(String(32), nullable=True)  # Telegram usernames are at most 32 chars
     first_name = Column(String(100), nullable=True)
     last_name = Column(String(100), nullable=True)
     phone = Column(String(20), nullable=True)
     email = Column(String(255), nullable=True)
-    language_code = Column(String(10), default="fa")
+    language_code = Column(String(10), server_default="fa")
     
     # New fields for onboarding
     display_name = Column(String(100), nullable=True)  # What to call them
-    onboarding_step = Column(SQLEnum(OnboardingStep), default=OnboardingStep.START)
-    onboarding_completed = Column(Boolean, default=False)
+    onboarding_step = Column(SQLEnum(OnboardingStep), server_default=OnboardingStep.START.name)
+    onboarding_completed = Column(Boolean, server_default=false())
     
     # Referral system
-    referral_code = Column(String(10), unique=True, nullable=True)
-    referred_by_code = Column(String(10), nullable=True)
-    referral_count = Column(Integer, default=0)
+    referral_code = Column(String(10), unique=True, nullable=True, index=True)
+    referred_by_code = Column(String(10), nullable=True, index=True)
+    referral_count = Column(Integer, server_default="0")
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
-    last_activity = Column(DateTime(timezone=True), default=func.now())
+    last_activity = Column(DateTime(timezone=True), server_default=func.now())
     
-    is_active = Column(Boolean, default=True)
-    is_blocked = Column(Boolean, default=False)
+    is_active = Column(Boolean, server_default=true())
+    is_blocked = Column(Boolean, server_default=false())
     
     # Relationships
-    profile = relationship("UserProfile", back_populates="user", uselist=False, cascade="all, delete-orphan")
-    subscription = relationship("Subscription", back_populates="user", uselist=False, cascade="all, delete-orphan")
+    # One-to-one relations needed by almost every handler are joined in the same query
+    profile = relationship("UserProfile", back_populates="user", uselist=False, cascade="all, delete-orphan", lazy="joined")
+    subscription = relationship("Subscription", back_populates="user", uselist=False, cascade="all, delete-orphan", lazy="joined")
     content_history = relationship("ContentHistory", back_populates="user", cascade="all, delete-orphan")
     prompts_used = relationship("PromptHistory", back_populates="user", cascade="all, delete-orphan")
     
     def generate_referral_code(self):
         """Generate unique referral code"""
         if not self.referral_code:
-            self.referral_code = ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(8))
+            # 5 random bytes encode to exactly 8 base32 characters (A-Z, 2-7)
+            self.referral_code = base64.b32encode(secrets.token_bytes(5)).decode("ascii")
 
 class UserProfile(Base):
     __tablename__ = "user_profiles"
+    __mapper_args__ = {"eager_defaults": True}
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     
     # Basic business info
     gallery_name = Column(String(200), nullable=True)
@@ -111,7 +119,7 @@ class UserProfile(Base):
     
     # AI analysis
     situation_summary = Column(Text, nullable=True)  # AI generated summary
-    summary_approved = Column(Boolean, default=False)
+    summary_approved = Column(Boolean, server_default=false())
     
     # Old fields (keeping for compatibility)
     page_style = Column(SQLEnum(PageStyle), nullable=True)
@@ -128,17 +136,18 @@ class UserProfile(Base):
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
+    __mapper_args__ = {"eager_defaults": True}
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     
-    status = Column(SQLEnum(SubscriptionStatus), default=SubscriptionStatus.TRIAL)
+    status = Column(SQLEnum(SubscriptionStatus), server_default=SubscriptionStatus.TRIAL.name, index=True)
     started_at = Column(DateTime(timezone=True), server_default=func.now())
-    expires_at = Column(DateTime(timezone=True), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
     
-    payment_amount = Column(Integer, default=0)  # In tomans
+    payment_amount = Column(Integer, server_default="0")  # In tomans
     payment_reference = Column(String(100), nullable=True)
-    discount_applied = Column(Float, default=0.0)  # Discount percentage
+    discount_applied = Column(Float, server_default="0")  # Discount percentage
     discount_code = Column(String(50), nullable=True)
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -148,17 +157,25 @@ class Subscription(Base):
     user = relationship("User", back_populates="subscription")
     
     @classmethod
-    def create_trial(cls, user_id: int, trial_days: int = 3):  # Changed to 3 days for new flow
+    def create_trial(cls, user_id: Optional[int] = None, trial_days: int = 3):  # Changed to 3 days for new flow
         return cls(
             user_id=user_id,
             status=SubscriptionStatus.TRIAL,
             expires_at=datetime.now(timezone.utc) + timedelta(days=trial_days)
         )
     
-    @property
+    @hybrid_property
     def is_active(self) -> bool:
         return self.expires_at > datetime.now(timezone.utc) and self.status in [SubscriptionStatus.TRIAL, SubscriptionStatus.ACTIVE]
 
+    @is_active.expression
+    def is_active(cls):
+        """SQL form, so active subscriptions can be filtered in the database"""
+        return and_(
+            cls.expires_at > func.now(),
+            cls.status.in_([SubscriptionStatus.TRIAL, SubscriptionStatus.ACTIVE])
+        )
+
 class ContentHistory(Base):
     __tablename__ = "content_history"
     
@@ -174,22 +191,41 @@ class ContentHistory(Base):
     # Relationships
     user = relationship("User", back_populates="content_history")
 
+# Histories are listed per user, newest first
+Index("ix_content_history_user_created", ContentHistory.user_id, ContentHistory.created_at.desc())
+
+class PromptTemplate(Base):
+    """Static system prompts, stored once and referenced from PromptHistory"""
+    __tablename__ = "prompt_templates"
+    
+    id = Column(Integer, primary_key=True)
+    digest = Column(String(64), unique=True, nullable=False)  # sha256 of content
+    name = Column(String(100), nullable=False)
+    content = Column(Text, nullable=False)
+    
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
 class PromptHistory(Base):
     """Track which prompts are used for content generation"""
     __tablename__ = "prompt_history"
+    __table_args__ = (
+        UniqueConstraint("user_id", "prompt_name", name="uq_prompt_user_name"),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     
     prompt_name = Column(String(100), nullable=False)  # e.g. "viral_reels_analysis"
-    prompt_content = Column(Text, nullable=False)
-    usage_count = Column(Integer, default=1)
+    prompt_content = Column(Text, nullable=False)  # The user's own part of the last prompt
+    prompt_template_id = Column(Integer, ForeignKey("prompt_templates.id"), nullable=True)
+    usage_count = Column(Integer, server_default="1")
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
     # Relationships
     user = relationship("User", back_populates="prompts_used")
+    template = relationship("PromptTemplate", lazy="joined")
 
 class DiscountCode(Base):
     """Discount codes for subscriptions"""
@@ -198,14 +234,14 @@ class DiscountCode(Base):
     id = Column(Integer, primary_key=True)
     code = Column(String(50), unique=True, nullable=False)
     discount_percentage = Column(Float, nullable=False)  # 0.1 = 10%
-    max_uses = Column(Integer, default=100)
-    current_uses = Column(Integer, default=0)
+    max_uses = Column(Integer, server_default="100")
+    current_uses = Column(Integer, server_default="0")
     expires_at = Column(DateTime(timezone=True), nullable=True)
     
-    is_active = Column(Boolean, default=True)
+    is_active = Column(Boolean, server_default=true())
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
-    @property
+    @hybrid_property
     def is_valid(self) -> bool:
         if not self.is_active:
             return False
@@ -213,4 +249,13 @@ class DiscountCode(Base):
             return False
         if self.expires_at and self.expires_at < datetime.now(timezone.utc):
             return False
-        return True
\ No newline at end of file
+        return True
+
+    @is_valid.expression
+    def is_valid(cls):
+        """SQL form, so valid codes can be filtered in the database"""
+        return and_(
+            cls.is_active.is_(True),
+            cls.current_uses < cls.max_uses,
+            or_(cls.expires_at.is_(None), cls.expires_at > func.now())
+        )
\ No newline at end of file
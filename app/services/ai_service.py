@@ -1,112 +1,280 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import httpx
+import random
+import re
+import textwrap
+import weakref
+from dataclasses import dataclass
 import openai
-from typing import List, Optional
+import orjson
+from cachetools import TTLCache
+from typing import AsyncIterator, Callable, ClassVar, Dict, List, NamedTuple, Optional, Tuple
 import logging
 from core.config import settings
+from core.redis_client import get_redis
 from models.schema import UserProfile, PageStyle, AudienceType, SalesGoal
 
 logger = logging.getLogger(__name__)
 
-class AIService:
-    def __init__(self):
-        """
-        Initializes the AI service with the modern OpenAI client.
-        """
-        # MODIFIED: Create an instance of the AsyncOpenAI client
-        self.client = openai.AsyncOpenAI(
-            api_key=settings.OPENROUTER_API_KEY,
-            base_url="https://openrouter.ai/api/v1",
-        )
-        logger.info("AIService initialized with OpenRouter client.")
-        self.last_prompt_name: Optional[str] = None
-        self.last_prompt_content: Optional[str] = None
+_STYLE_PROMPTS = {
+    PageStyle.SERIOUS: "رسمی، حرفه‌ای و معتبر",
+    PageStyle.FRIENDLY: "دوستانه، صمیمی و نزدیک به مشتری",
+    PageStyle.LUXURY: "لوکس، مجلل و اشرافی",
+    PageStyle.TRADITIONAL: "سنتی، اصیل و فرهنگی"
+}
 
-    async def _call_ai(self, system_prompt: str, user_prompt: str) -> str:
-        """
-        Calls the OpenRouter AI API using the modern openai>=1.0.0 syntax.
-        """
-        try:
-            response = await self.client.chat.completions.create(
-                model="openai/gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.8,
-                max_tokens=2000
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            logger.error(f"OpenRouter API error: {e}", exc_info=True)
-            raise
+_AUDIENCE_PROMPTS = {
+    AudienceType.YOUTH: "جوانان و نسل جدید",
+    AudienceType.LUXURY: "مشتریان لاکچری و پولdar",
+    AudienceType.BRIDES: "عروس‌خانم‌ها و زوج‌های جوان",
+    AudienceType.GENERAL: "عموم مردم"
+}
 
-    async def generate_caption(
-        self,
-        product_description: str,
-        user_profile: UserProfile,
-        additional_context: Optional[str] = None,
-        from_voice: bool = False
-    ) -> List[str]:
-        """Generate 3 captions for a product"""
-        style_prompt = self._get_style_prompt(user_profile.page_style)
-        audience_prompt = self._get_audience_prompt(user_profile.audience_type)
-        goal_prompt = self._get_goal_prompt(user_profile.sales_goal)
+_GOAL_PROMPTS = {
+    SalesGoal.INCREASE_SALES: "افزایش فروش و تبدیل مخاطب به مشتری",
+    SalesGoal.BRAND_AWARENESS: "افزایش آگاهی از برند و شناخت",
+    SalesGoal.ENGAGEMENT: "افزایش تعامل و لایک و کامنت"
+}
+
+class _ProfileFragments(NamedTuple):
+    style: str
+    audience: str
+    goal: str
+
+@functools.lru_cache(maxsize=256)
+def _profile_fragments(
+    page_style: Optional[PageStyle],
+    audience_type: Optional[AudienceType],
+    sales_goal: Optional[SalesGoal]
+) -> _ProfileFragments:
+    """Prompt text for a profile's style, audience and goal, computed once per combination"""
+    return _ProfileFragments(
+        style=_STYLE_PROMPTS.get(page_style, "دوستانه و طبیعی"),
+        audience=_AUDIENCE_PROMPTS.get(audience_type, "عموم مردم"),
+        goal=_GOAL_PROMPTS.get(sales_goal, "افزایش فروش")
+    )
+
+# Start of a numbered item ("1." or "۱."). Items are cut between consecutive
+# markers, which keeps the pattern free of lookahead and lazy quantifiers.
+_ITEM_MARKER_RE = re.compile(r'(?m)^\s*[1-3۱-۳][.．]\s*')
+
+# Every item marker, numbered or headed, contains one of these digits. Text without
+# any of them cannot hold a marker, which is cheaper to check than running the regex.
+_MARKER_DIGITS = frozenset("123۱۲۳")
+
+def _split_numbered_items(content: str) -> List[str]:
+    """Return the text of each numbered item; an item runs until the next marker"""
+    bounds = [(match.start(), match.end()) for match in _ITEM_MARKER_RE.finditer(content)]
+    ends = [start for start, _ in bounds[1:]] + [len(content)]
+    return [content[body:end].strip() for (_, body), end in zip(bounds, ends)]
+
+# "سناریو ۱:" / "ایده ۱:" headers that start each reels scenario or visual idea
+_PERSIAN_HEADER_RE = re.compile(r'(سناریو\s*[۱۲۳123]\s*:|ایده\s*[۱۲۳123]\s*:)', re.IGNORECASE)
+
+# Theme of the reels scenarios shown at the end of onboarding
+ONBOARDING_REELS_THEME = "معرفی گالری طلا و جواهرات"
+
+# Appended to system prompts whose answer is requested as a JSON object
+_JSON_ITEMS_INSTRUCTION = "\n\nپاسخ را فقط به صورت JSON با کلید items که لیستی از 3 رشته است برگردان."
+
+# Short or tightly structured outputs go to the fast model, the rest to the main one
+_MODEL_FOR = {
+    "caption_generation": settings.AI_FAST_MODEL,
+    "content_calendar": settings.AI_FAST_MODEL,
+    "reels_generation": settings.AI_MODEL,
+    "visual_ideas_generation": settings.AI_MODEL,
+    "situation_summary": settings.AI_MODEL,
+}
+# Batch API jobs go directly to OpenAI, so they use an OpenAI model name of their own
+_BATCH_MODEL = settings.AI_BATCH_MODEL
+
+# Transient OpenRouter failures (429, 5xx, network) are retried with jittered
+# exponential backoff, or after the server's Retry-After when it sends one;
+# anything else (bad request, auth) fails immediately
+_RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,
+    openai.APITimeoutError
+)
+_MAX_ATTEMPTS = 4
+_RETRY_BASE_DELAY = 0.5
+_RETRY_MAX_DELAY = 8.0
+# Longest server-requested wait we honor; the request holds a concurrency slot meanwhile
+_RETRY_AFTER_MAX = 30.0
+
+class _EmptyCompletionError(Exception):
+    """The model returned no text (refusal, content filter or no choices at all)"""
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds from the Retry-After header of an HTTP error response, if present and numeric"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return min(float(response.headers["retry-after"]), _RETRY_AFTER_MAX)
+    except (KeyError, ValueError):
+        return None
+
+# Completion budgets sized to each output (Persian text is token-heavy); generation
+# time and cost grow with the tokens emitted. The system prompts cap the length of
+# each item in words, and the budgets leave headroom above those caps.
+_CAPTION_MAX_TOKENS = 450
+_REELS_MAX_TOKENS = 1100
+_VISUAL_MAX_TOKENS = 1000
+_CALENDAR_MAX_TOKENS = 800
+_SUMMARY_MAX_TOKENS = 800
+# Per choice, for prompts that ask for a single caption
+_SINGLE_CAPTION_MAX_TOKENS = 200
+
+# Temperatures for the extra requests made when a provider ignores `n`; spread out
+# so the separately generated items still differ from each other
+_CHOICE_FALLBACK_TEMPERATURES = (0.7, 0.85, 1.0)
+
+
+@dataclass(frozen=True, slots=True)
+class PromptTrace:
+    """The prompt parts sent for one generation; the combined text is only built when read"""
+    name: str
+    system: str
+    user: str
+    context: Optional[str] = None
+
+    @property
+    def content(self) -> str:
+        # System prompts are module constants that are already stripped
+        system = self.system
+        if self.context:
+            system = f"{system}\n{self.context.strip()}"
+        return f"SYSTEM:\n{system}\n\nUSER:\n{self.user.strip()}"
+
+
+# Trace of the last prompt sent. A ContextVar rather than instance state, so
+# concurrent generations on one AIService don't overwrite each other.
+_last_prompt: contextvars.ContextVar[Optional[PromptTrace]] = contextvars.ContextVar("last_prompt", default=None)
+
+# Completed responses keyed by a hash of the model and prompts. Identical prompts (same
+# profile settings and same product) are answered without another API call. The
+# in-process cache sits in front of Redis, which shares responses across workers
+# and restarts when REDIS_URL is configured.
+_RESPONSE_CACHE: TTLCache = TTLCache(maxsize=settings.AI_CACHE_MAX_ENTRIES, ttl=settings.AI_CACHE_TTL_SECONDS)
+_REDIS_CACHE_PREFIX = "ai:response:"
+# One lock per prompt being generated, so concurrent identical requests share one API call
+_INFLIGHT_LOCKS: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+async def _cache_get(key: str) -> Optional[str]:
+    cached = _RESPONSE_CACHE.get(key)
+    if cached is not None:
+        return cached
+    redis = get_redis()
+    if redis is None:
+        return None
+    try:
+        cached = await redis.get(_REDIS_CACHE_PREFIX + key)
+    except Exception as e:
+        logger.warning("Redis AI cache lookup failed: %s", e)
+        return None
+    if cached is not None:
+        _RESPONSE_CACHE[key] = cached
+    return cached
+
+async def _cache_set(key: str, response: str) -> None:
+    _RESPONSE_CACHE[key] = response
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.set(_REDIS_CACHE_PREFIX + key, response, ex=settings.AI_REDIS_CACHE_TTL_SECONDS)
+    except Exception as e:
+        logger.warning("Redis AI cache store failed: %s", e)
+
+# Near-duplicate prompts (a paraphrased product description) are answered from here
+# when the exact-match cache misses. Off unless AI_SEMANTIC_CACHE_ENABLED is set.
+# Imported only when enabled, so the embedding stack (torch, sentence-transformers,
+# hnswlib) is neither loaded nor required otherwise.
+_SEMANTIC_CACHE = None
+if settings.AI_SEMANTIC_CACHE_ENABLED:
+    from services.semantic_cache import SemanticCache
+    _SEMANTIC_CACHE = SemanticCache()
 
-        system_prompt = f"""
+async def _semantic_get(namespace: str, prompt: str, subject: str) -> Optional[str]:
+    try:
+        return await _SEMANTIC_CACHE.get(namespace, prompt, subject)
+    except Exception as e:
+        logger.warning("Semantic cache lookup failed: %s", e)
+        return None
+
+async def _semantic_add(namespace: str, prompt: str, subject: str, response: str) -> None:
+    try:
+        await _SEMANTIC_CACHE.add(namespace, prompt, subject, response)
+    except Exception as e:
+        logger.warning("Semantic cache store failed: %s", e)
+
+# Providers that only cache prompt prefixes marked with cache_control. OpenAI models
+# cache long prefixes automatically and need no marker.
+_CACHE_CONTROL_PROVIDERS = ("anthropic/", "google/")
+
+def _build_messages(
+    system_prompt: str,
+    system_context: Optional[str],
+    user_prompt: str,
+    model: str = settings.AI_MODEL
+) -> List[dict]:
+    """
+    The static system prompt always comes first so repeated calls share an identical
+    prefix that the provider can serve from its prompt cache; per-user context follows.
+    """
+    if model.startswith(_CACHE_CONTROL_PROVIDERS):
+        system_content = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+    else:
+        system_content = system_prompt
+    messages = [{"role": "system", "content": system_content}]
+    if system_context:
+        messages.append({"role": "system", "content": system_context})
+    messages.append({"role": "user", "content": user_prompt})
+    return messages
+
+_VOICE_INPUT_NOTE = "- ورودی از پیام صوتی تبدیل شده، اگر نکات زائد یا تکراری داشت نادیده بگیر"
+
+# Static role, rules and output format for each generator. These never change
+# between calls; everything that depends on the user goes in the context message.
+# Dedented and stripped once here rather than on every request.
+_CAPTION_SYSTEM_PROMPT = textwrap.dedent("""
         تو یک متخصص بازاریابی طلا و جواهرات هستی که برای صفحات اینستاگرام فارسی کپشن می‌نویسی.
         
-        سبک نوشتن: {style_prompt}
-        نوع مخاطب: {audience_prompt}
-        هدف اصلی: {goal_prompt}
-        
-        {f"اطلاعات کسب‌وکار: {user_profile.business_name} - {user_profile.business_description}" if user_profile.business_name else ""}
-        
         قوانین:
         - حتماً 3 کپشن مختلف بنویس
         - هر کپشن را با عدد شماره‌گذاری کن
+        - هر کپشن حداکثر ۵۰ کلمه باشد
         - از ایموجی مناسب استفاده کن
         - CTA (فراخوان عمل) در پایان هر کپشن بیاور
         - کپشن‌ها باید جذاب و متقاعدکننده باشند
         - زبان فارسی روان و طبیعی استفاده کن
-        {f"- ورودی از پیام صوتی تبدیل شده، اگر نکات زائد یا تکراری داشت نادیده بگیر" if from_voice else ""}
-        """
-        
-        user_prompt = f"""
-        محصول: {product_description}
-        {f"توضیحات اضافی: {additional_context}" if additional_context else ""}
-        
-        لطفاً 3 کپشن مختلف برای این محصول بنویس.
-        """
+        - سبک، مخاطب و هدف را از اطلاعات کسب‌وکار که در ادامه می‌آید رعایت کن
+        """).strip()
 
-        try:
-            self.last_prompt_name = "caption_generation"
-            self.last_prompt_content = f"SYSTEM:\n{system_prompt.strip()}\n\nUSER:\n{user_prompt.strip()}"
-            response = await self._call_ai(system_prompt, user_prompt)
-            captions = self._parse_numbered_content(response, 3)
-            return captions
-        except Exception as e:
-            logger.error(f"Error generating captions: {e}")
-            return ["خطا در تولید کپشن. لطفاً دوباره تلاش کنید."]
-    
-    async def generate_reels_scenario(
-        self,
-        theme: str,
-        user_profile: UserProfile,
-        occasion: Optional[str] = None,
-        from_voice: bool = False
-    ) -> List[str]:
-        """Generate Instagram Reels scenarios with enhanced prompt engineering"""
-        style_prompt = self._get_style_prompt(user_profile.page_style)
-        audience_prompt = self._get_audience_prompt(user_profile.audience_type)
+# Single-caption variant, used with n=3 so the three captions are decoded in parallel
+# as separate choices instead of one numbered list
+_SINGLE_CAPTION_SYSTEM_PROMPT = textwrap.dedent("""
+        تو یک متخصص بازاریابی طلا و جواهرات هستی که برای صفحات اینستاگرام فارسی کپشن می‌نویسی.
         
-        system_prompt = f"""
+        قوانین:
+        - فقط یک کپشن بنویس، بدون شماره‌گذاری و بدون توضیح اضافه
+        - از ایموجی مناسب استفاده کن
+        - CTA (فراخوان عمل) در پایان کپشن بیاور
+        - کپشن باید جذاب و متقاعدکننده باشد
+        - زبان فارسی روان و طبیعی استفاده کن
+        - کپشن حداکثر ۵۰ کلمه باشد
+        - سبک، مخاطب و هدف را از اطلاعات کسب‌وکار که در ادامه می‌آید رعایت کن
+        """).strip()
+
+_REELS_SYSTEM_PROMPT = textwrap.dedent("""
         تو یک کارگردان محتوای اینستاگرام حرفه‌ای و خبره هستی که مختص طلا و جواهرات کار می‌کنی. 
         تخصص اصلی‌ت تولید سناریوهای ریلز ویرال و جذاب است.
         
-        سبک محتوای مورد نظر: {style_prompt}
-        مخاطب هدف: {audience_prompt}
-        نام گالری: {user_profile.gallery_name or 'گالری کاربر'}
-        اینستاگرام: {user_profile.instagram_handle or 'instagram_handle'}
-        
         ⚠️ قوانین سخت‌گیرانه تولید سناریو:
         1. حتماً 3 سناریو کاملاً مختلف و مجزا تولید کن
         2. هر سناریو را دقیقاً با این فرمت شروع کن: "سناریو ۱:" یا "سناریو ۲:" یا "سناریو ۳:"
@@ -129,46 +297,13 @@ class AIService:
         - سناریوها باید قابل اجرا و عملی باشند
         - از ترندهای روز استفاده کن
         - هر سناریو را با عدد شماره‌گذاری کن
-        {f"- ورودی از پیام صوتی تبدیل شده، اگر نکات زائد یا تکراری داشت نادیده بگیر" if from_voice else ""}
-        """
-        
-        user_prompt = f"""
-        موضوع اصلی: {theme}
-        {f"مناسبت: {occasion}" if occasion else ""}
-        مشتریان اصلی: {user_profile.main_customers or 'عموم'}
-        
-        حالا 3 سناریو ریلز کاملاً حرفه‌ای و عملی برای این موضوع تولید کن.
-        هر سناریو را با "سناریو ۱:", "سناریو ۲:", "سناریو ۳:" شروع کن.
-        """
-        
-        try:
-            self.last_prompt_name = "reels_generation"
-            self.last_prompt_content = f"SYSTEM:\n{system_prompt.strip()}\n\nUSER:\n{user_prompt.strip()}"
-            response = await self._call_ai(system_prompt, user_prompt)
-            scenarios = self._parse_persian_numbered_content(response, 3)
-            return scenarios
-        except Exception as e:
-            logger.error(f"Error generating reels scenarios: {e}")
-            return ["خطا در تولید سناریو ریلز. لطفاً دوباره تلاش کنید."]
+        - هر سناریو حداکثر ۱۲۰ کلمه باشد، بدون مقدمه و جمع‌بندی
+        """).strip()
 
-    async def generate_visual_ideas(
-        self,
-        product_type: str,
-        user_profile: UserProfile,
-        available_props: Optional[str] = None,
-        from_voice: bool = False
-    ) -> List[str]:
-        """Generate professional visual ideas with enhanced prompt engineering"""
-        style_prompt = self._get_style_prompt(user_profile.page_style)
-        
-        system_prompt = f"""
+_VISUAL_SYSTEM_PROMPT = textwrap.dedent("""
         تو یک مشاور عکاسی حرفه‌ای و خبره برای طلا و جواهرات هستی که ایده‌های بصری جذاب و قابل اجرا ارائه می‌دهی.
         تخصص اصلی‌ت کمک به طلافروشان برای عکاسی محصولات‌شان به شکل حرفه‌ای است.
         
-        سبک مورد نظر: {style_prompt}
-        نام گالری: {user_profile.gallery_name or 'گالری کاربر'}
-        مخاطب هدف: {user_profile.main_customers or 'عموم مردم'}
-        
         ⚠️ قوانین سخت‌گیرانه تولید ایده بصری:
         1. حتماً 3 ایده بصری کاملاً مختلف و عملی تولید کن
         2. هر ایده را دقیقاً با این فرمت شروع کن: "ایده ۱:" یا "ایده ۲:" یا "ایده ۳:"
@@ -185,7 +320,6 @@ class AIService:
         6. از کلمات تخصصی پیچیده خودداری کن
         7. هر ایده باید منحصر به فرد و خلاقانه باشد
         8. مناسب فروش آنلاین و جذب مشتری باشد
-        سبک مطلوب: {style_prompt}
         
         قوانین:
         - 3 ایده بصری مختلف ارائه بده
@@ -193,45 +327,877 @@ class AIService:
         - ایده‌ها باید با امکانات موجود قابل اجرا باشند
         - نکات فنی عکاسی را هم بگو
         - هر ایده را با عدد شماره‌گذاری کن
-        {f"- ورودی از پیام صوتی تبدیل شده، اگر نکات زائد یا تکراری داشت نادیده بگیر" if from_voice else ""}
-        """
+        - هر ایده حداکثر ۱۰۰ کلمه باشد، بدون مقدمه و جمع‌بندی
+        """).strip()
+
+_SUMMARY_SYSTEM_PROMPT = (
+    "تو یک مشاور حرفه‌ای در زمینه بازاریابی و استراتژی محتوا برای طلافروشان هستی. "
+    "بر اساس اطلاعات کاربر، یک تحلیل ساختاریافته و کاربردی به زبان فارسی ارائه بده که شامل بخش‌های زیر باشد:\n"
+    "1. تحلیل وضعیت فعلی (نقاط قوت و ضعف)\n"
+    "2. پیشنهادات عملی برای بهبود\n"
+    "3. شناخت مخاطبان هدف\n"
+    "4. راهکارهای محتوایی\n\n"
+    "رعایت این نکات ضروری است:\n"
+    "- از عناوین شماره‌دار و نشانه‌گذاری ساده استفاده کن\n"
+    "- از علامت‌هایی مانند #، *، - در ابتدای خطوط خودداری کن\n"
+    "- لحن حرفه‌ای ولی قابل فهم و دوستانه داشته باش\n"
+    "- پیشنهادات باید عملی و متناسب با کسب‌وکار طلا باشد\n"
+    "- جملات کوتاه و گویا باشند\n"
+    "- کل تحلیل حداکثر ۳۰۰ کلمه باشد"
+)
+
+_CALENDAR_SYSTEM_PROMPT = (
+    "تو یک استراتژیست محتوای تخصصی برای طلا و جواهرات هستی. بر اساس مشخصات کسب‌وکار مشتری، "
+    "3 ایده محتوایی جذاب برای شبکه‌های اجتماعی پیشنهاد بده. هر ایده باید شامل:\n"
+    "1. نوع محتوا (پست، ریلز، استوری، لایو)\n"
+    "2. زمان مناسب (مثلاً 'هفته اول همکاری' یا 'پس از 2 هفته')\n"
+    "3. توضیحات کامل شامل:\n"
+    "   - ایده اصلی و زاویه دید\n"
+    "   - پیشنهاد اجرا\n"
+    "   - نکات فنی و بصری\n"
+    "   - نحوه ارتباط با مخاطب\n\n"
+    "محتوا باید:\n"
+    "- کاملاً مرتبط با صنف طلا و جواهر باشد\n"
+    "- با مشخصات کسب‌وکار مشتری هماهنگ باشد\n"
+    "- برای مخاطبان ایرانی طراحی شده باشد\n"
+    "- از اصطلاحات فنی و حرفه‌ای استفاده کند\n"
+    "- دارای نوآوری و جذابیت بصری باشد\n"
+    "- هر ایده حداکثر ۸۰ کلمه باشد"
+    + _JSON_ITEMS_INSTRUCTION
+)
+
+# Digests of the static system prompts, computed once at import. Cache keys hash
+# the short digest instead of re-hashing kilobytes of identical text on every call.
+_STATIC_PROMPT_DIGESTS: Dict[str, str] = {
+    prompt: hashlib.sha256(prompt.encode()).hexdigest()
+    for prompt in (
+        _CAPTION_SYSTEM_PROMPT,
+        _SINGLE_CAPTION_SYSTEM_PROMPT,
+        _REELS_SYSTEM_PROMPT,
+        _VISUAL_SYSTEM_PROMPT,
+        _SUMMARY_SYSTEM_PROMPT,
+        _CALENDAR_SYSTEM_PROMPT,
+    )
+}
+
+def _response_cache_key(model: str, system_prompt: str, *prompts: Optional[str]) -> str:
+    system_digest = _STATIC_PROMPT_DIGESTS.get(system_prompt) or hashlib.sha256(system_prompt.encode()).hexdigest()
+    return hashlib.sha256("|".join([model, system_digest, *(p or "" for p in prompts)]).encode()).hexdigest()
+
+def _voice_variants(template: str) -> Dict[bool, str]:
+    """Both from_voice variants of a context template, keyed by from_voice"""
+    return {
+        False: template.replace("{voice_note}", "").strip(),
+        True: template.replace("{voice_note}", _VOICE_INPUT_NOTE),
+    }
+
+# Per-user context templates, one pair per generator so the voice note is already
+# in place and building a context is a dict lookup plus one str.format call
+_CAPTION_CONTEXT_TEMPLATES = _voice_variants(textwrap.dedent("""
+        سبک نوشتن: {style}
+        نوع مخاطب: {audience}
+        هدف اصلی: {goal}
         
-        user_prompt = f"""
+        {business}
+        {voice_note}
+        """).strip())
+
+_REELS_CONTEXT_TEMPLATES = _voice_variants(textwrap.dedent("""
+        سبک محتوای مورد نظر: {style}
+        مخاطب هدف: {audience}
+        نام گالری: {gallery_name}
+        اینستاگرام: {instagram_handle}
+        {voice_note}
+        """).strip())
+
+_VISUAL_CONTEXT_TEMPLATES = _voice_variants(textwrap.dedent("""
+        سبک مورد نظر: {style}
+        نام گالری: {gallery_name}
+        مخاطب هدف: {main_customers}
+        {voice_note}
+        """).strip())
+
+# User prompt templates; optional lines are filled in by the prompt builders
+_CAPTION_USER_TEMPLATE = textwrap.dedent("""
+        محصول: {product}
+        {extra}
+        
+        لطفاً 3 کپشن مختلف برای این محصول بنویس.
+        """).strip()
+
+_SINGLE_CAPTION_USER_TEMPLATE = textwrap.dedent("""
+        محصول: {product}
+        {extra}
+        
+        لطفاً یک کپشن برای این محصول بنویس.
+        """).strip()
+
+_REELS_USER_TEMPLATE = textwrap.dedent("""
+        موضوع اصلی: {theme}
+        {occasion}
+        مشتریان اصلی: {main_customers}
+        
+        حالا 3 سناریو ریلز کاملاً حرفه‌ای و عملی برای این موضوع تولید کن.
+        هر سناریو را با "سناریو ۱:", "سناریو ۲:", "سناریو ۳:" شروع کن.
+        """).strip()
+
+_VISUAL_USER_TEMPLATE = textwrap.dedent("""
         نوع محصول: {product_type}
-        {f"وسایل و امکانات موجود: {available_props}" if available_props else "امکانات استاندارد گالری"}
-        محدودیت‌ها: {user_profile.constraints_and_guidelines or 'بدون محدودیت خاص'}
+        {props}
+        محدودیت‌ها: {constraints}
         
         حالا 3 ایده بصری کاملاً حرفه‌ای و عملی برای عکاسی این محصول تولید کن.
         هر ایده را با "ایده ۱:", "ایده ۲:", "ایده ۳:" شروع کن.
         ایده‌ها باید جذاب، قابل اجرا و مناسب فروش آنلاین باشند.
+        """).strip()
+
+# The per-user context only depends on a handful of profile fields, so each
+# distinct combination is built once and reused across requests.
+@functools.lru_cache(maxsize=1024)
+def _build_caption_system_context(
+    style_prompt: str,
+    audience_prompt: str,
+    goal_prompt: str,
+    business_name: Optional[str],
+    business_description: Optional[str],
+    from_voice: bool
+) -> str:
+    return _CAPTION_CONTEXT_TEMPLATES[from_voice].format(
+        style=style_prompt,
+        audience=audience_prompt,
+        goal=goal_prompt,
+        business=f"اطلاعات کسب‌وکار: {business_name} - {business_description}" if business_name else "",
+    )
+
+@functools.lru_cache(maxsize=1024)
+def _build_reels_system_context(
+    style_prompt: str,
+    audience_prompt: str,
+    gallery_name: Optional[str],
+    instagram_handle: Optional[str],
+    from_voice: bool
+) -> str:
+    return _REELS_CONTEXT_TEMPLATES[from_voice].format(
+        style=style_prompt,
+        audience=audience_prompt,
+        gallery_name=gallery_name or 'گالری کاربر',
+        instagram_handle=instagram_handle or 'instagram_handle',
+    )
+
+@functools.lru_cache(maxsize=1024)
+def _build_visual_system_context(
+    style_prompt: str,
+    gallery_name: Optional[str],
+    main_customers: Optional[str],
+    from_voice: bool
+) -> str:
+    return _VISUAL_CONTEXT_TEMPLATES[from_voice].format(
+        style=style_prompt,
+        gallery_name=gallery_name or 'گالری کاربر',
+        main_customers=main_customers or 'عموم مردم',
+    )
+
+class AIService:
+    __slots__ = ()
+
+    # One OpenRouter client for the whole process, so its connection pool
+    # and TLS sessions are reused by every AIService instance
+    _client: ClassVar[Optional[openai.AsyncOpenAI]] = None
+    _batch_client: ClassVar[Optional[openai.AsyncOpenAI]] = None
+    # Bounds in-flight requests across all instances so concurrent generations
+    # stay within OpenRouter rate limits
+    _semaphore: ClassVar[asyncio.Semaphore] = asyncio.Semaphore(settings.AI_MAX_CONCURRENCY)
+
+    @property
+    def last_prompt(self) -> Optional[PromptTrace]:
+        """Trace of the prompt most recently sent from the current task"""
+        return _last_prompt.get()
+
+    @property
+    def last_prompt_name(self) -> Optional[str]:
+        """Name of the prompt most recently sent from the current task"""
+        trace = _last_prompt.get()
+        return trace.name if trace else None
+
+    @property
+    def last_prompt_content(self) -> Optional[str]:
+        """Full text of the prompt most recently sent from the current task"""
+        trace = _last_prompt.get()
+        return trace.content if trace else None
+
+    @classmethod
+    def client(cls) -> openai.AsyncOpenAI:
+        """
+        Returns the shared OpenRouter client, creating it on first use.
+        """
+        if cls._client is None:
+            cls._client = openai.AsyncOpenAI(
+                api_key=settings.OPENROUTER_API_KEY,
+                base_url="https://openrouter.ai/api/v1",
+                # Retries are handled by _create_completion
+                max_retries=0,
+                # Requests go through aiohttp instead of httpx's own transport, which
+                # holds up much better under many concurrent requests
+                http_client=openai.DefaultAioHttpClient(
+                    limits=httpx.Limits(
+                        max_connections=200,
+                        max_keepalive_connections=100,
+                        keepalive_expiry=60
+                    ),
+                    # Completions can take a while to generate; connecting should not
+                    timeout=httpx.Timeout(60.0, connect=5.0)
+                ),
+            )
+            logger.info("AIService initialized with OpenRouter client.")
+        return cls._client
+
+    @classmethod
+    def batch_client(cls) -> openai.AsyncOpenAI:
+        """
+        Returns the direct OpenAI client used for the Batch API, which OpenRouter
+        does not offer. Requires OPENAI_API_KEY.
+        """
+        if cls._batch_client is None:
+            if not settings.OPENAI_API_KEY:
+                raise RuntimeError("OPENAI_API_KEY is required for batch generation")
+            cls._batch_client = openai.AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+        return cls._batch_client
+
+    @classmethod
+    async def warmup(cls) -> None:
+        """
+        Opens the OpenRouter connection at startup with a cheap models.list() call, so the
+        first user request doesn't pay for DNS, TCP and TLS setup. Failures are only logged.
+        """
+        try:
+            await cls.client().models.list(timeout=10.0)
+            logger.info("OpenRouter connection warmed up.")
+        except (openai.APIError, asyncio.TimeoutError) as e:
+            logger.warning("OpenRouter warmup failed: %s", e)
+
+    @classmethod
+    async def aclose(cls) -> None:
+        """Closes the shared clients and their connection pools."""
+        if cls._client is not None:
+            await cls._client.close()
+            cls._client = None
+        if cls._batch_client is not None:
+            await cls._batch_client.close()
+            cls._batch_client = None
+        if _SEMANTIC_CACHE is not None:
+            await asyncio.to_thread(_SEMANTIC_CACHE.save)
+
+    async def _call_ai(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        json_mode: bool = False,
+        system_context: Optional[str] = None,
+        max_tokens: int = 2000,
+        model: str = settings.AI_MODEL,
+        semantic_subject: Optional[str] = None
+    ) -> str:
+        """
+        Calls the OpenRouter AI API, answering repeated prompts from the response cache.
+        With json_mode the model is constrained to return a single JSON object.
+        When semantic_subject (e.g. the product description) is given, similar earlier
+        prompts about a matching subject can also be answered from the semantic cache.
+        """
+        key = _response_cache_key(model, system_prompt, system_context, user_prompt)
+        cached = await _cache_get(key)
+        if cached is not None:
+            logger.info("AI cache HIT for %s", self.last_prompt_name)
+            return cached
+
+        lock = _INFLIGHT_LOCKS.get(key)
+        if lock is None:
+            lock = _INFLIGHT_LOCKS[key] = asyncio.Lock()
+        async with lock:
+            # Another request may have filled the cache while we waited
+            cached = _RESPONSE_CACHE.get(key)
+            if cached is not None:
+                logger.info("AI cache HIT for %s", self.last_prompt_name)
+                return cached
+            use_semantic = _SEMANTIC_CACHE is not None and semantic_subject is not None
+            if use_semantic:
+                namespace = _response_cache_key(model, system_prompt, system_context)
+                similar = await _semantic_get(namespace, user_prompt, semantic_subject)
+                if similar is not None:
+                    logger.info("AI semantic cache HIT for %s", self.last_prompt_name)
+                    await _cache_set(key, similar)
+                    return similar
+            logger.info("AI cache MISS for %s", self.last_prompt_name)
+            response = await self._request_completion(
+                system_prompt, user_prompt, json_mode, system_context, max_tokens, model
+            )
+            # An empty completion would otherwise be served as a cache hit for the whole TTL
+            if not response:
+                return response
+            await _cache_set(key, response)
+            if use_semantic:
+                await _semantic_add(namespace, user_prompt, semantic_subject, response)
+            return response
+
+    async def _call_ai_choices(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        n: int,
+        system_context: Optional[str] = None,
+        max_tokens: int = 2000,
+        model: str = settings.AI_MODEL,
+        semantic_subject: Optional[str] = None
+    ) -> List[str]:
+        """
+        Returns `n` independent completions of a single-item prompt, decoded in parallel
+        by the provider via the `n` parameter. If the provider returns fewer choices, the
+        rest are requested concurrently at varied temperatures. Cached as a JSON list.
+        """
+        key = _response_cache_key(model, system_prompt, system_context, user_prompt, f"n={n}")
+        cached = await _cache_get(key)
+        if cached is not None:
+            logger.info("AI cache HIT for %s", self.last_prompt_name)
+            return orjson.loads(cached)
+        use_semantic = _SEMANTIC_CACHE is not None and semantic_subject is not None
+        if use_semantic:
+            namespace = _response_cache_key(model, system_prompt, system_context, f"n={n}")
+            similar = await _semantic_get(namespace, user_prompt, semantic_subject)
+            if similar is not None:
+                logger.info("AI semantic cache HIT for %s", self.last_prompt_name)
+                await _cache_set(key, similar)
+                return orjson.loads(similar)
+        logger.info("AI cache MISS for %s", self.last_prompt_name)
+
+        choices = await self._request_choices(
+            system_prompt, user_prompt, system_context=system_context,
+            max_tokens=max_tokens, model=model, n=n
+        )
+        if len(choices) < n:
+            extra = await asyncio.gather(*(
+                self._request_choices(
+                    system_prompt, user_prompt, system_context=system_context,
+                    max_tokens=max_tokens, model=model, temperature=temperature
+                )
+                for temperature in _CHOICE_FALLBACK_TEMPERATURES[:n - len(choices)]
+            ))
+            choices += [choice for batch in extra for choice in batch]
+        choices = [choice for choice in choices[:n] if choice]
+
+        # A short or empty result is a partial failure; don't pin it in the cache
+        if len(choices) < n:
+            return choices
+
+        serialized = orjson.dumps(choices).decode()
+        await _cache_set(key, serialized)
+        if use_semantic:
+            await _semantic_add(namespace, user_prompt, semantic_subject, serialized)
+        return choices
+
+    async def _create_completion(self, **kwargs):
+        """
+        Calls chat.completions.create, retrying transient errors. The caller holds the
+        semaphore, so a rate-limited request keeps its slot while it backs off.
+        """
+        for attempt in range(1, _MAX_ATTEMPTS + 1):
+            try:
+                return await self.client().chat.completions.create(**kwargs)
+            except _RETRYABLE_ERRORS as e:
+                if attempt == _MAX_ATTEMPTS:
+                    raise
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(_RETRY_MAX_DELAY, _RETRY_BASE_DELAY * 2 ** attempt))
+                logger.warning(
+                    "OpenRouter %s on attempt %d/%d, retrying in %.1fs",
+                    type(e).__name__, attempt, _MAX_ATTEMPTS, delay
+                )
+                await asyncio.sleep(delay)
+
+    async def _request_completion(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        json_mode: bool = False,
+        system_context: Optional[str] = None,
+        max_tokens: int = 2000,
+        model: str = settings.AI_MODEL
+    ) -> str:
+        """
+        Calls the OpenRouter AI API using the modern openai>=1.0.0 syntax.
+        """
+        choices = await self._request_choices(
+            system_prompt, user_prompt, json_mode, system_context, max_tokens, model
+        )
+        if not choices or not choices[0]:
+            raise _EmptyCompletionError(f"Empty completion for {self.last_prompt_name}")
+        return choices[0]
+
+    async def _request_choices(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        json_mode: bool = False,
+        system_context: Optional[str] = None,
+        max_tokens: int = 2000,
+        model: str = settings.AI_MODEL,
+        n: int = 1,
+        temperature: float = 0.8
+    ) -> List[str]:
+        """
+        Requests `n` completions of one prompt in a single API call. max_tokens applies
+        to each choice. Some providers ignore `n` and return fewer choices.
         """
+        try:
+            async with self._semaphore:
+                response = await self._create_completion(
+                    model=model,
+                    messages=_build_messages(system_prompt, system_context, user_prompt, model),
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    n=n if n > 1 else openai.NOT_GIVEN,
+                    response_format={"type": "json_object"} if json_mode else openai.NOT_GIVEN
+                )
+            if response.usage:
+                logger.debug("Completion used %d/%d tokens", response.usage.completion_tokens, max_tokens * n)
+            if any(choice.finish_reason == "length" for choice in response.choices):
+                logger.warning("Completion for %s hit max_tokens=%d and was cut off", self.last_prompt_name, max_tokens)
+            # Refusals and filtered responses come back with content set to null
+            return [(choice.message.content or "").strip() for choice in response.choices]
+        except openai.RateLimitError:
+            logger.warning("OpenRouter rate limit persisted after retries")
+            raise
+        except openai.APIError as e:
+            logger.error("OpenRouter API error: %s", e)
+            raise
+
+    async def _stream_ai(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        system_context: Optional[str] = None,
+        max_tokens: int = 2000,
+        model: str = settings.AI_MODEL,
+        semantic_subject: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        Streams the completion text as it is generated. The full response is
+        cached once the stream finishes, and a cached response is yielded at once.
+        """
+        key = _response_cache_key(model, system_prompt, system_context, user_prompt)
+        cached = await _cache_get(key)
+        if cached is not None:
+            logger.info("AI cache HIT for %s", self.last_prompt_name)
+            yield cached
+            return
+        use_semantic = _SEMANTIC_CACHE is not None and semantic_subject is not None
+        if use_semantic:
+            namespace = _response_cache_key(model, system_prompt, system_context)
+            similar = await _semantic_get(namespace, user_prompt, semantic_subject)
+            if similar is not None:
+                logger.info("AI semantic cache HIT for %s", self.last_prompt_name)
+                await _cache_set(key, similar)
+                yield similar
+                return
+        logger.info("AI cache MISS for %s", self.last_prompt_name)
+
+        parts: List[str] = []
+        try:
+            async with self._semaphore:
+                stream = await self._create_completion(
+                    model=model,
+                    messages=_build_messages(system_prompt, system_context, user_prompt, model),
+                    temperature=0.8,
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+                    if chunk.choices[0].finish_reason == "length":
+                        logger.warning(
+                            "Streamed completion for %s hit max_tokens=%d and was cut off",
+                            self.last_prompt_name, max_tokens
+                        )
+        except openai.RateLimitError:
+            logger.warning("OpenRouter rate limit persisted after retries")
+            raise
+        except openai.APIError as e:
+            logger.error("OpenRouter API streaming error: %s", e)
+            raise
+        response = "".join(parts).strip()
+        if not response:
+            return
+        await _cache_set(key, response)
+        if use_semantic:
+            await _semantic_add(namespace, user_prompt, semantic_subject, response)
+
+    async def _stream_items(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        system_context: Optional[str],
+        marker_re: "re.Pattern[str]",
+        parse: Callable[[str, int], List[str]],
+        expected_count: int = 3,
+        keep_marker: bool = False,
+        max_tokens: int = 2000,
+        model: str = settings.AI_MODEL,
+        semantic_subject: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        Streams a completion and yields each item as soon as the marker of the next
+        item arrives. If no item was yielded by the end of the stream, the whole text
+        is parsed with `parse`; otherwise only the unemitted tail is split on its markers.
+        With keep_marker the marker text (e.g. "سناریو ۱:") heads the yielded item.
+        """
+        buffer = ""
+        # (marker start, marker end) of each item seen so far. Scanning resumes where
+        # the previous delta left off, so each character is examined once or twice.
+        markers: List[Tuple[int, int]] = []
+        scan_from = 0
+        emitted = 0
+        async for delta in self._stream_ai(
+            system_prompt, user_prompt, system_context, max_tokens, model, semantic_subject
+        ):
+            buffer += delta
+            if not _MARKER_DIGITS.isdisjoint(buffer[scan_from:]):
+                for match in marker_re.finditer(buffer, scan_from):
+                    markers.append((match.start(), match.end()))
+                    scan_from = match.end()
+            # Markers never span lines, so only a marker cut off on the unfinished
+            # last line still needs a second look
+            scan_from = max(scan_from, buffer.rfind("\n") + 1)
+            # An item is complete once the next item has started
+            while emitted < expected_count and emitted + 1 < len(markers):
+                (start, end), (next_start, _) = markers[emitted], markers[emitted + 1]
+                body = buffer[end:next_start].strip()
+                yield f"{buffer[start:end].strip()}\n{body}" if keep_marker else body
+                emitted += 1
+        if emitted == 0:
+            for item in parse(buffer.strip(), expected_count):
+                yield item
+            return
+        # Re-parsing the whole buffer could fall back to splitting on blank lines
+        # (e.g. when truncation dropped a marker) and repeat text already sent, so
+        # only the markers from the first unemitted one onwards are used
+        ends = [start for start, _ in markers[emitted + 1:]] + [len(buffer)]
+        for (start, end), next_start in zip(markers[emitted:expected_count], ends):
+            body = buffer[end:next_start].strip()
+            if body:
+                yield f"{buffer[start:end].strip()}\n{body}" if keep_marker else body
+
+    async def generate_caption(
+        self,
+        product_description: str,
+        user_profile: UserProfile,
+        additional_context: Optional[str] = None,
+        from_voice: bool = False
+    ) -> List[str]:
+        """Generate 3 captions for a product, as 3 parallel choices of a single-caption prompt"""
+        system_context, user_prompt = self._caption_prompts(
+            product_description, user_profile, additional_context, from_voice, single=True
+        )
+        system_prompt = _SINGLE_CAPTION_SYSTEM_PROMPT
+
+        try:
+            _last_prompt.set(PromptTrace("caption_generation", system_prompt, user_prompt, system_context))
+            captions = await self._call_ai_choices(
+                system_prompt, user_prompt, 3, system_context=system_context,
+                max_tokens=_SINGLE_CAPTION_MAX_TOKENS, model=_MODEL_FOR["caption_generation"],
+                semantic_subject=product_description
+            )
+            return captions or ["خطا در تولید کپشن. لطفاً دوباره تلاش کنید."]
+        except Exception as e:
+            # API errors were already logged where the request failed
+            if not isinstance(e, openai.APIError):
+                logger.error("Error generating captions: %s", e)
+            return ["خطا در تولید کپشن. لطفاً دوباره تلاش کنید."]
+
+    async def generate_caption_stream(
+        self,
+        product_description: str,
+        user_profile: UserProfile,
+        additional_context: Optional[str] = None,
+        from_voice: bool = False
+    ) -> AsyncIterator[str]:
+        """Yield each of the 3 captions as soon as the model finishes writing it"""
+        system_context, user_prompt = self._caption_prompts(
+            product_description, user_profile, additional_context, from_voice
+        )
+        system_prompt = _CAPTION_SYSTEM_PROMPT
+        _last_prompt.set(PromptTrace("caption_generation", system_prompt, user_prompt, system_context))
+
+        emitted = 0
+        try:
+            async for caption in self._stream_items(
+                system_prompt, user_prompt, system_context,
+                _ITEM_MARKER_RE, self._parse_numbered_content,
+                max_tokens=_CAPTION_MAX_TOKENS, model=_MODEL_FOR["caption_generation"],
+                semantic_subject=product_description
+            ):
+                emitted += 1
+                yield caption
+        except Exception as e:
+            # API errors were already logged where the request failed
+            if not isinstance(e, openai.APIError):
+                logger.error("Error streaming captions: %s", e)
+            if not emitted:
+                yield "خطا در تولید کپشن. لطفاً دوباره تلاش کنید."
+
+    def _caption_prompts(
+        self,
+        product_description: str,
+        user_profile: UserProfile,
+        additional_context: Optional[str],
+        from_voice: bool,
+        single: bool = False
+    ) -> Tuple[str, str]:
+        """
+        Build the per-user system context and the user prompt for caption generation.
+        With single the prompt asks for one caption, for use with several choices.
+        """
+        fragments = _profile_fragments(user_profile.page_style, user_profile.audience_type, user_profile.sales_goal)
+
+        system_context = _build_caption_system_context(
+            fragments.style,
+            fragments.audience,
+            fragments.goal,
+            user_profile.business_name,
+            user_profile.business_description,
+            from_voice
+        )
+        
+        template = _SINGLE_CAPTION_USER_TEMPLATE if single else _CAPTION_USER_TEMPLATE
+        user_prompt = template.format(
+            product=product_description,
+            extra=f"توضیحات اضافی: {additional_context}" if additional_context else "",
+        )
+        return system_context, user_prompt
+    
+    async def generate_reels_scenario(
+        self,
+        theme: str,
+        user_profile: UserProfile,
+        occasion: Optional[str] = None,
+        from_voice: bool = False
+    ) -> List[str]:
+        """Generate Instagram Reels scenarios with enhanced prompt engineering"""
+        system_context, user_prompt = self._reels_prompts(theme, user_profile, occasion, from_voice)
         
         try:
-            self.last_prompt_name = "visual_ideas_generation"
-            self.last_prompt_content = f"SYSTEM:\n{system_prompt.strip()}\n\nUSER:\n{user_prompt.strip()}"
-            response = await self._call_ai(system_prompt, user_prompt)
+            system_prompt = _REELS_SYSTEM_PROMPT
+            _last_prompt.set(PromptTrace("reels_generation", system_prompt, user_prompt, system_context))
+            response = await self._call_ai(
+                system_prompt, user_prompt, system_context=system_context,
+                max_tokens=_REELS_MAX_TOKENS, model=_MODEL_FOR["reels_generation"]
+            )
+            scenarios = self._parse_persian_numbered_content(response, 3)
+            return scenarios
+        except Exception as e:
+            # API errors were already logged where the request failed
+            if not isinstance(e, openai.APIError):
+                logger.error("Error generating reels scenarios: %s", e)
+            return ["خطا در تولید سناریو ریلز. لطفاً دوباره تلاش کنید."]
+
+    async def generate_reels_scenario_stream(
+        self,
+        theme: str,
+        user_profile: UserProfile,
+        occasion: Optional[str] = None,
+        from_voice: bool = False
+    ) -> AsyncIterator[str]:
+        """Yield each of the 3 reels scenarios as soon as the model finishes writing it"""
+        system_context, user_prompt = self._reels_prompts(theme, user_profile, occasion, from_voice)
+        system_prompt = _REELS_SYSTEM_PROMPT
+        _last_prompt.set(PromptTrace("reels_generation", system_prompt, user_prompt, system_context))
+
+        emitted = 0
+        try:
+            async for scenario in self._stream_items(
+                system_prompt, user_prompt, system_context,
+                _PERSIAN_HEADER_RE, self._parse_persian_numbered_content,
+                keep_marker=True, max_tokens=_REELS_MAX_TOKENS, model=_MODEL_FOR["reels_generation"]
+            ):
+                emitted += 1
+                yield scenario
+        except Exception as e:
+            # API errors were already logged where the request failed
+            if not isinstance(e, openai.APIError):
+                logger.error("Error streaming reels scenarios: %s", e)
+            if not emitted:
+                yield "خطا در تولید سناریو ریلز. لطفاً دوباره تلاش کنید."
+
+    def _reels_prompts(
+        self,
+        theme: str,
+        user_profile: UserProfile,
+        occasion: Optional[str],
+        from_voice: bool
+    ) -> Tuple[str, str]:
+        """Build the per-user system context and the user prompt for reels scenarios"""
+        fragments = _profile_fragments(user_profile.page_style, user_profile.audience_type, user_profile.sales_goal)
+        
+        system_context = _build_reels_system_context(
+            fragments.style,
+            fragments.audience,
+            user_profile.gallery_name,
+            user_profile.instagram_handle,
+            from_voice
+        )
+        
+        user_prompt = _REELS_USER_TEMPLATE.format(
+            theme=theme,
+            occasion=f"مناسبت: {occasion}" if occasion else "",
+            main_customers=user_profile.main_customers or 'عموم',
+        )
+        return system_context, user_prompt
+
+    async def generate_visual_ideas(
+        self,
+        product_type: str,
+        user_profile: UserProfile,
+        available_props: Optional[str] = None,
+        from_voice: bool = False
+    ) -> List[str]:
+        """Generate professional visual ideas with enhanced prompt engineering"""
+        system_context, user_prompt = self._visual_prompts(product_type, user_profile, available_props, from_voice)
+        
+        try:
+            system_prompt = _VISUAL_SYSTEM_PROMPT
+            _last_prompt.set(PromptTrace("visual_ideas_generation", system_prompt, user_prompt, system_context))
+            response = await self._call_ai(
+                system_prompt, user_prompt, system_context=system_context,
+                max_tokens=_VISUAL_MAX_TOKENS, model=_MODEL_FOR["visual_ideas_generation"],
+                semantic_subject=product_type
+            )
             ideas = self._parse_persian_numbered_content(response, 3)
             return ideas
         except Exception as e:
-            logger.error(f"Error generating visual ideas: {e}")
+            # API errors were already logged where the request failed
+            if not isinstance(e, openai.APIError):
+                logger.error("Error generating visual ideas: %s", e)
             return ["خطا در تولید ایده بصری. لطفاً دوباره تلاش کنید."]
 
+    async def generate_visual_ideas_stream(
+        self,
+        product_type: str,
+        user_profile: UserProfile,
+        available_props: Optional[str] = None,
+        from_voice: bool = False
+    ) -> AsyncIterator[str]:
+        """Yield each of the 3 visual ideas as soon as the model finishes writing it"""
+        system_context, user_prompt = self._visual_prompts(product_type, user_profile, available_props, from_voice)
+        system_prompt = _VISUAL_SYSTEM_PROMPT
+        _last_prompt.set(PromptTrace("visual_ideas_generation", system_prompt, user_prompt, system_context))
+
+        emitted = 0
+        try:
+            async for idea in self._stream_items(
+                system_prompt, user_prompt, system_context,
+                _PERSIAN_HEADER_RE, self._parse_persian_numbered_content,
+                keep_marker=True, max_tokens=_VISUAL_MAX_TOKENS, model=_MODEL_FOR["visual_ideas_generation"],
+                semantic_subject=product_type
+            ):
+                emitted += 1
+                yield idea
+        except Exception as e:
+            # API errors were already logged where the request failed
+            if not isinstance(e, openai.APIError):
+                logger.error("Error streaming visual ideas: %s", e)
+            if not emitted:
+                yield "خطا در تولید ایده بصری. لطفاً دوباره تلاش کنید."
+
+    def _visual_prompts(
+        self,
+        product_type: str,
+        user_profile: UserProfile,
+        available_props: Optional[str],
+        from_voice: bool
+    ) -> Tuple[str, str]:
+        """Build the per-user system context and the user prompt for visual ideas"""
+        fragments = _profile_fragments(user_profile.page_style, user_profile.audience_type, user_profile.sales_goal)
+        
+        system_context = _build_visual_system_context(
+            fragments.style,
+            user_profile.gallery_name,
+            user_profile.main_customers,
+            from_voice
+        )
+        
+        user_prompt = _VISUAL_USER_TEMPLATE.format(
+            product_type=product_type,
+            props=f"وسایل و امکانات موجود: {available_props}" if available_props else "امکانات استاندارد گالری",
+            constraints=user_profile.constraints_and_guidelines or 'بدون محدودیت خاص',
+        )
+        return system_context, user_prompt
+
+    async def generate_all(
+        self,
+        product_description: str,
+        theme: str,
+        product_type: str,
+        user_profile: UserProfile,
+        from_voice: bool = False
+    ) -> Dict[str, List[str]]:
+        """Generate captions, reels scenarios and visual ideas concurrently"""
+        results = await asyncio.gather(
+            self.generate_caption(product_description, user_profile, from_voice=from_voice),
+            self.generate_reels_scenario(theme, user_profile, from_voice=from_voice),
+            self.generate_visual_ideas(product_type, user_profile, from_voice=from_voice),
+            return_exceptions=True
+        )
+        fallbacks = {
+            "captions": "خطا در تولید کپشن. لطفاً دوباره تلاش کنید.",
+            "reels": "خطا در تولید سناریو ریلز. لطفاً دوباره تلاش کنید.",
+            "visuals": "خطا در تولید ایده بصری. لطفاً دوباره تلاش کنید.",
+        }
+        bundle: Dict[str, List[str]] = {}
+        for (key, fallback), result in zip(fallbacks.items(), results):
+            if isinstance(result, BaseException):
+                logger.error("Error generating %s in bundle: %s", key, result)
+                bundle[key] = [fallback]
+            else:
+                bundle[key] = result
+        return bundle
+
+    async def generate_onboarding_bundle(self, user_profile: UserProfile) -> Dict[str, object]:
+        """
+        Generate the onboarding situation summary and the introductory reels scenarios
+        concurrently, so the scenarios are ready by the time the summary is confirmed.
+        A failure in one falls back to its error text without discarding the other.
+        """
+        summary, scenarios = await asyncio.gather(
+            self.generate_situation_summary(user_profile),
+            self.generate_reels_scenario(theme=ONBOARDING_REELS_THEME, user_profile=user_profile),
+            return_exceptions=True
+        )
+        if isinstance(summary, BaseException):
+            logger.error("Error generating situation summary in onboarding bundle: %s", summary)
+            summary = "خلاصه وضعیت آماده نشد. بعداً دوباره تلاش کنید."
+        if isinstance(scenarios, BaseException):
+            logger.error("Error generating reels in onboarding bundle: %s", scenarios)
+            scenarios = ["خطا در تولید سناریو ریلز. لطفاً دوباره تلاش کنید."]
+        return {"summary": summary, "scenarios": scenarios}
+
     async def generate_situation_summary(self, user_profile: UserProfile) -> str:
         """Generate Persian situation summary from collected onboarding info"""
-        system_prompt = (
-            "تو یک مشاور حرفه‌ای در زمینه بازاریابی و استراتژی محتوا برای طلافروشان هستی. "
-            "بر اساس اطلاعات کاربر، یک تحلیل ساختاریافته و کاربردی به زبان فارسی ارائه بده که شامل بخش‌های زیر باشد:\n"
-            "1. تحلیل وضعیت فعلی (نقاط قوت و ضعف)\n"
-            "2. پیشنهادات عملی برای بهبود\n"
-            "3. شناخت مخاطبان هدف\n"
-            "4. راهکارهای محتوایی\n\n"
-            "رعایت این نکات ضروری است:\n"
-            "- از عناوین شماره‌دار و نشانه‌گذاری ساده استفاده کن\n"
-            "- از علامت‌هایی مانند #، *، - در ابتدای خطوط خودداری کن\n"
-            "- لحن حرفه‌ای ولی قابل فهم و دوستانه داشته باش\n"
-            "- پیشنهادات باید عملی و متناسب با کسب‌وکار طلا باشد\n"
-            "- جملات کوتاه و گویا باشند"
-        )
+        system_prompt, user_prompt = self._summary_prompts(user_profile)
+        try:
+            _last_prompt.set(PromptTrace("situation_summary", system_prompt, user_prompt))
+            return await self._call_ai(
+                system_prompt, user_prompt,
+                max_tokens=_SUMMARY_MAX_TOKENS, model=_MODEL_FOR["situation_summary"]
+            )
+        except (openai.APIError, asyncio.TimeoutError, _EmptyCompletionError):
+            return "خلاصه وضعیت آماده نشد. بعداً دوباره تلاش کنید."
+
+    def _summary_prompts(self, user_profile: UserProfile) -> Tuple[str, str]:
+        """Build the system and user prompts for the situation summary"""
+        system_prompt = _SUMMARY_SYSTEM_PROMPT
         user_prompt = (
             f"اطلاعات کسب‌وکار:\n"
             f"نام گالری: {user_profile.gallery_name}\n"
@@ -244,37 +1210,101 @@ class AIService:
             f"اطلاعات تکمیلی: {user_profile.additional_info or 'ثبت نشده'}\n\n"
             f"لطفاً تحلیل کاملی ارائه دهید:"
         )
-        try:
-            self.last_prompt_name = "situation_summary"
-            self.last_prompt_content = f"SYSTEM:\n{system_prompt.strip()}\n\nUSER:\n{user_prompt.strip()}"
-            return await self._call_ai(system_prompt, user_prompt)
-        except Exception:
-            return "خلاصه وضعیت آماده نشد. بعداً دوباره تلاش کنید."
+        return system_prompt, user_prompt
+
+    async def generate_situation_summary_batch(
+        self,
+        profiles: List[UserProfile],
+        concurrency: int = 8
+    ) -> Dict[int, str]:
+        """
+        Generates situation summaries for many profiles concurrently, at most `concurrency`
+        at a time, and returns them keyed by user id. Results are collected as they
+        complete, so one slow request doesn't hold up the rest; a failed profile gets
+        the usual fallback text instead of failing the whole batch.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def summarize(profile: UserProfile) -> Tuple[int, str]:
+            async with semaphore:
+                return profile.user_id, await self.generate_situation_summary(profile)
+
+        results: Dict[int, str] = {}
+        for next_done in asyncio.as_completed([summarize(profile) for profile in profiles]):
+            user_id, summary = await next_done
+            results[user_id] = summary
+        return results
+
+    async def submit_summary_batch(self, profiles: List[UserProfile]) -> str:
+        """
+        Queues situation summaries for many profiles on the OpenAI Batch API
+        (half price, completed within 24h). Returns the batch id for poll_batch.
+        """
+        lines = []
+        for profile in profiles:
+            system_prompt, user_prompt = self._summary_prompts(profile)
+            lines.append(orjson.dumps({
+                "custom_id": str(profile.user_id),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": _BATCH_MODEL,
+                    # Built for the batch model, so no provider-specific cache_control
+                    # parts reach the OpenAI Batch API
+                    "messages": _build_messages(system_prompt, None, user_prompt, _BATCH_MODEL),
+                    "temperature": 0.8,
+                    "max_tokens": _SUMMARY_MAX_TOKENS
+                }
+            }))
+        client = self.batch_client()
+        batch_file = await client.files.create(
+            file=("situation_summaries.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info("Submitted summary batch %s for %d profiles", batch.id, len(lines))
+        return batch.id
+
+    async def poll_batch(self, batch_id: str) -> Optional[Dict[int, str]]:
+        """
+        Returns the completed responses of a batch keyed by user id,
+        or None while the batch is still running.
+        """
+        client = self.batch_client()
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            logger.info("Batch %s is %s", batch_id, batch.status)
+            return None
+        if not batch.output_file_id:
+            return {}
+
+        output = await client.files.content(batch.output_file_id)
+        results: Dict[int, str] = {}
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            item = orjson.loads(line)
+            response = item.get("response") or {}
+            if item.get("error") or response.get("status_code") != 200:
+                logger.warning("Batch %s request %s failed: %s", batch_id, item.get('custom_id'), item.get('error'))
+                continue
+            content = response["body"]["choices"][0]["message"]["content"]
+            results[int(item["custom_id"])] = content.strip()
+        return results
 
     async def generate_content_calendar(self, user_profile: UserProfile) -> List[str]:
         """Generate a short 3-item content calendar suggestion"""
-        system_prompt = (
-            "تو یک استراتژیست محتوای تخصصی برای طلا و جواهرات هستی. بر اساس مشخصات کسب‌وکار مشتری، "
-            "3 ایده محتوایی جذاب برای شبکه‌های اجتماعی پیشنهاد بده. هر ایده باید شامل:\n"
-            "1. نوع محتوا (پست، ریلز، استوری، لایو)\n"
-            "2. زمان مناسب (مثلاً 'هفته اول همکاری' یا 'پس از 2 هفته')\n"
-            "3. توضیحات کامل شامل:\n"
-            "   - ایده اصلی و زاویه دید\n"
-            "   - پیشنهاد اجرا\n"
-            "   - نکات فنی و بصری\n"
-            "   - نحوه ارتباط با مخاطب\n\n"
-            "محتوا باید:\n"
-            "- کاملاً مرتبط با صنف طلا و جواهر باشد\n"
-            "- با مشخصات کسب‌وکار مشتری هماهنگ باشد\n"
-            "- برای مخاطبان ایرانی طراحی شده باشد\n"
-            "- از اصطلاحات فنی و حرفه‌ای استفاده کند\n"
-            "- دارای نوآوری و جذابیت بصری باشد"
-        )
+        system_prompt = _CALENDAR_SYSTEM_PROMPT
+        fragments = _profile_fragments(user_profile.page_style, user_profile.audience_type, user_profile.sales_goal)
         user_prompt = (
             f"مشخصات کسب‌وکار:\n"
             f"نام گالری: {user_profile.gallery_name}\n"
             f"مخاطبان اصلی: {user_profile.main_customers}\n"
-            f"سبک صفحه: {self._get_style_prompt(user_profile.page_style)}\n"
+            f"سبک صفحه: {fragments.style}\n"
             f"محدودیت‌ها: {user_profile.constraints_and_guidelines}\n"
             f"کمک‌کنندگان محتوا: {user_profile.content_help}\n"
             f"فروشگاه فیزیکی: {'دارد' if user_profile.has_physical_store else 'ندارد'}\n"
@@ -282,30 +1312,30 @@ class AIService:
             f"لطفاً 3 ایده محتوایی ارائه دهید:"
         )
         try:
-            self.last_prompt_name = "content_calendar"
-            self.last_prompt_content = f"SYSTEM:\n{system_prompt.strip()}\n\nUSER:\n{user_prompt.strip()}"
-            response = await self._call_ai(system_prompt, user_prompt)
-            return self._parse_numbered_content(response, 3)
-        except Exception:
+            _last_prompt.set(PromptTrace("content_calendar", system_prompt, user_prompt))
+            response = await self._call_ai(
+                system_prompt, user_prompt, json_mode=True,
+                max_tokens=_CALENDAR_MAX_TOKENS, model=_MODEL_FOR["content_calendar"]
+            )
+            return self._parse_json_items(response, 3)
+        except (openai.APIError, asyncio.TimeoutError, _EmptyCompletionError):
             return ["خطا در تولید تقویم."]
 
+    def _parse_json_items(self, content: str, expected_count: int) -> List[str]:
+        """Parse a JSON mode response of the form {"items": [...]}"""
+        try:
+            items = orjson.loads(content)["items"]
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            items = None
+        if isinstance(items, list):
+            items = [item.strip() for item in items if isinstance(item, str) and item.strip()]
+        if not items:
+            return self._parse_numbered_content(content, expected_count)
+        return items[:expected_count]
+
     def _parse_numbered_content(self, content: str, expected_count: int) -> List[str]:
         """Parse numbered content from AI response"""
-        lines = content.strip().split('\n')
-        parsed_content = []
-        current_item = ""
-        
-        for line in lines:
-            line = line.strip()
-            if line.startswith(('1.', '2.', '3.', '۱.', '۲.', '۳.')):
-                if current_item:
-                    parsed_content.append(current_item.strip())
-                current_item = line
-            elif current_item:
-                current_item += f"\n{line}"
-        
-        if current_item:
-            parsed_content.append(current_item.strip())
+        parsed_content = [item for item in _split_numbered_items(content) if item]
         
         if len(parsed_content) < expected_count:
             chunks = content.split('\n\n')
@@ -321,26 +1351,14 @@ class AIService:
         # Split by Persian markers (scenarios or ideas)
         items = []
         
-        # Look for Persian markers
-        import re
-        # Pattern for both scenarios and ideas
-        pattern = r'(سناریو\s*[۱۲۳123]\s*:|ایده\s*[۱۲۳123]\s*:)'
-        
-        parts = re.split(pattern, content, flags=re.IGNORECASE)
-        
-        # The first part might be empty or contain intro text
-        if len(parts) > 1:
-            current_header = ""
-            for i, part in enumerate(parts):
-                part = part.strip()
-                if re.match(pattern, part, re.IGNORECASE):
-                    # This is a header
-                    current_header = part
-                elif current_header and part:
-                    # This is content following a header
-                    full_item = f"{current_header}\n{part}"
-                    items.append(full_item)
-                    current_header = ""
+        # Splitting on the capturing pattern alternates text and headers:
+        # [intro, header, body, header, body, ...]. The intro might be empty or
+        # contain intro text, and is dropped; no fragment needs matching again.
+        parts = _PERSIAN_HEADER_RE.split(content)
+        for header, body in zip(parts[1::2], parts[2::2]):
+            body = body.strip()
+            if body:
+                items.append(f"{header.strip()}\n{body}")
         
         # Fallback to original parsing if no items found
         if not items:
@@ -354,32 +1372,3 @@ class AIService:
                     if chunk.strip() and (('سناریو' in chunk) or ('ایده' in chunk))]
         
         return items[:expected_count] if items else [content]
-    
-    def _get_style_prompt(self, style: PageStyle) -> str:
-        """Get style-specific prompt"""
-        style_prompts = {
-            PageStyle.SERIOUS: "رسمی، حرفه‌ای و معتبر",
-            PageStyle.FRIENDLY: "دوستانه، صمیمی و نزدیک به مشتری", 
-            PageStyle.LUXURY: "لوکس، مجلل و اشرافی",
-            PageStyle.TRADITIONAL: "سنتی، اصیل و فرهنگی"
-        }
-        return style_prompts.get(style, "دوستانه و طبیعی")
-    
-    def _get_audience_prompt(self, audience: AudienceType) -> str:
-        """Get audience-specific prompt"""
-        audience_prompts = {
-            AudienceType.YOUTH: "جوانان و نسل جدید",
-            AudienceType.LUXURY: "مشتریان لاکچری و پولdar",
-            AudienceType.BRIDES: "عروس‌خانم‌ها و زوج‌های جوان",
-            AudienceType.GENERAL: "عموم مردم"
-        }
-        return audience_prompts.get(audience, "عموم مردم")
-
-    def _get_goal_prompt(self, goal: SalesGoal) -> str:
-        """Get goal-specific prompt"""
-        goal_prompts = {
-            SalesGoal.INCREASE_SALES: "افزایش فروش و تبدیل مخاطب به مشتری",
-            SalesGoal.BRAND_AWARENESS: "افزایش آگاهی از برند و شناخت",
-            SalesGoal.ENGAGEMENT: "افزایش تعامل و لایک و کامنت"
-        }
-        return goal_prompts.get(goal, "افزایش فروش")
\ No newline at end of file
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+import re
+from typing import Dict, FrozenSet, List, Optional
+
+import orjson
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"\w+")
+_DIGIT_RE = re.compile(r"[0-9۰-۹]")
+
+
+def _tokens(text: str) -> FrozenSet[str]:
+    return frozenset(_TOKEN_RE.findall(text.lower()))
+
+
+def _subjects_match(query: FrozenSet[str], cached: FrozenSet[str]) -> bool:
+    """
+    Lexical guard on top of embedding similarity. Embeddings place "18 karat ring"
+    and "21 karat ring" almost on top of each other, so numbers must match exactly
+    and at least half of the query's words must appear in the cached subject.
+    """
+    if {t for t in query if _DIGIT_RE.search(t)} != {t for t in cached if _DIGIT_RE.search(t)}:
+        return False
+    return bool(query) and len(query & cached) * 2 >= len(query)
+
+
+class SemanticCache:
+    """
+    In-process nearest-neighbour cache of completions. Prompts are embedded with a
+    multilingual sentence-transformers model and looked up in an HNSW index, so a
+    paraphrased request for the same product is answered without an API call.
+
+    Entries are grouped by namespace (model + system prompt + per-user context), and
+    a hit must be in the same namespace and pass the lexical subject check.
+    """
+
+    def __init__(
+        self,
+        model_name: str = settings.AI_SEMANTIC_CACHE_MODEL,
+        max_distance: float = settings.AI_SEMANTIC_CACHE_MAX_DISTANCE,
+        max_entries: int = settings.AI_SEMANTIC_CACHE_MAX_ENTRIES,
+        path: Optional[str] = settings.AI_SEMANTIC_CACHE_PATH
+    ):
+        self.model_name = model_name
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.path = path
+        # SentenceTransformer and hnswlib.Index, created by _load on first use
+        self._model = None
+        self._index = None
+        # Metadata per index label: namespace, subject tokens and the cached response
+        self._entries: List[Dict] = []
+        self._init_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+
+    async def _ensure_ready(self) -> None:
+        """Loads the embedding model and the index on first use, off the event loop"""
+        if self._index is not None:
+            return
+        async with self._init_lock:
+            if self._index is None:
+                await asyncio.to_thread(self._load)
+
+    def _load(self) -> None:
+        # Heavy optional dependencies, imported only once the cache is actually used
+        import hnswlib
+        from sentence_transformers import SentenceTransformer
+
+        logger.info("Loading semantic cache embedding model: %s", self.model_name)
+        model = SentenceTransformer(self.model_name, device="cpu")
+        index = hnswlib.Index(space="cosine", dim=model.get_sentence_embedding_dimension())
+        entries: List[Dict] = []
+        if self.path and os.path.exists(f"{self.path}.index") and os.path.exists(f"{self.path}.json"):
+            index.load_index(f"{self.path}.index", max_elements=self.max_entries)
+            with open(f"{self.path}.json", "rb") as f:
+                entries = orjson.loads(f.read())
+            logger.info("Loaded %d semantic cache entries from %s", len(entries), self.path)
+        else:
+            index.init_index(max_elements=self.max_entries, ef_construction=200, M=16)
+        index.set_ef(50)
+        for entry in entries:
+            entry["subject"] = frozenset(entry["subject"])
+        self._model, self._entries, self._index = model, entries, index
+
+    def _embed(self, text: str):
+        return self._model.encode([text], normalize_embeddings=True)
+
+    async def get(self, namespace: str, prompt: str, subject: str) -> Optional[str]:
+        """Returns the cached response for the nearest similar prompt, if close enough"""
+        await self._ensure_ready()
+        if not self._entries:
+            return None
+        vector = await asyncio.to_thread(self._embed, prompt)
+        labels, distances = self._index.knn_query(vector, k=min(5, len(self._entries)))
+        query_subject = _tokens(subject)
+        for label, distance in zip(labels[0], distances[0]):
+            if distance > self.max_distance:
+                break
+            entry = self._entries[label]
+            if entry["namespace"] == namespace and _subjects_match(query_subject, entry["subject"]):
+                return entry["response"]
+        return None
+
+    async def add(self, namespace: str, prompt: str, subject: str, response: str) -> None:
+        """Stores a completion; new entries are dropped once the index is full"""
+        await self._ensure_ready()
+        if len(self._entries) >= self.max_entries:
+            return
+        vector = await asyncio.to_thread(self._embed, prompt)
+        async with self._write_lock:
+            if len(self._entries) >= self.max_entries:
+                return
+            self._index.add_items(vector, [len(self._entries)])
+            self._entries.append({"namespace": namespace, "subject": _tokens(subject), "response": response})
+
+    def save(self) -> None:
+        """Writes the index and its metadata to `path`, if one is configured"""
+        if not self.path or self._index is None:
+            return
+        self._index.save_index(f"{self.path}.index")
+        with open(f"{self.path}.json", "wb") as f:
+            f.write(orjson.dumps([{**entry, "subject": sorted(entry["subject"])} for entry in self._entries]))
+        logger.info("Saved %d semantic cache entries to %s", len(self._entries), self.path)
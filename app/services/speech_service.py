@@ -1,14 +1,16 @@
 import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
 import os
-import tempfile
 import logging
-from typing import Optional
+from typing import BinaryIO, List, Optional, Tuple, Union
 from pathlib import Path
 
 import aiofiles
+import av
+import numpy as np
 import torch
 from transformers import pipeline
-from pydub import AudioSegment
 import librosa
 import soundfile as sf
 
@@ -17,6 +19,11 @@ from core.config import settings
 logger = logging.getLogger(__name__)
 
 
+# Whisper's expected input sample rate
+SAMPLE_RATE = 16000
+OGG_MAGIC = b"OggS"
+
+
 class SpeechService:
     def __init__(self):
         """
@@ -24,34 +31,151 @@ class SpeechService:
         """
         self._pipeline = None
         self.model_name = settings.WHISPER_MODEL_NAME
+        self.backend = settings.WHISPER_BACKEND
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.max_file_size_bytes = settings.AUDIO_MAX_FILE_SIZE_MB * 1024 * 1024
         self.max_duration_seconds = settings.AUDIO_MAX_DURATION_SECONDS
-        logger.info(f"SpeechService initialized. Using device: {self.device}, Model: {self.model_name}")
+        # Decoded voice notes waiting for the batch worker, with the future for each result
+        self._queue: Optional[asyncio.Queue[Tuple[np.ndarray, asyncio.Future]]] = None
+        self._batch_worker_task: Optional[asyncio.Task] = None
+        # Audio decoding and Whisper get their own threads, so neither queues behind
+        # the other or behind unrelated users of the loop's default executor. A single
+        # Whisper thread keeps model calls (and CUDA work) from interleaving.
+        self._audio_pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="audio")
+        self._whisper_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisper")
+        logger.info(f"SpeechService initialized. Using device: {self.device}, Model: {self.model_name}, Backend: {self.backend}")
 
     async def _get_pipeline(self):
         """
-        Lazy initialization of the speech recognition pipeline.
+        Lazy initialization of the speech recognition pipeline, or of the
+        CTranslate2 model when the faster-whisper backend is configured.
         """
         if self._pipeline is None:
             logger.info(f"Loading Whisper model: {self.model_name}")
             # Run model loading in executor to avoid blocking
             loop = asyncio.get_event_loop()
-            self._pipeline = await loop.run_in_executor(
-                None,
-                lambda: pipeline(
-                    "automatic-speech-recognition",
-                    model=self.model_name,
-                    device=0 if self.device == "cuda" else -1,
-                    return_timestamps=True
-                )
-            )
+            self._pipeline = await loop.run_in_executor(self._whisper_pool, self._load_model)
             logger.info("Whisper model loaded successfully")
         return self._pipeline
 
-    async def download_voice_file(self, bot, file_id: str, voice_duration: int = None, voice_file_size: int = None) -> str:
+    async def warmup(self) -> None:
+        """
+        Loads the model at startup and runs it once on a second of silence, so CUDA
+        kernels and cuDNN algorithms are selected before the first user's voice note
+        arrives. Failures are only logged; the model is loaded again on first use.
+        """
+        try:
+            pipe = await self._get_pipeline()
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(
+                self._whisper_pool,
+                self._transcribe_sync,
+                pipe,
+                np.zeros(SAMPLE_RATE, dtype=np.float32)
+            )
+            logger.info("Whisper model warmed up.")
+        except Exception as e:
+            logger.warning(f"Whisper warmup failed: {e}")
+
+    def _load_model(self):
+        if self.backend == "faster-whisper":
+            # Optional dependency, only needed for this backend
+            from faster_whisper import WhisperModel
+
+            # int8 weights run on the CPU's integer dot-product instructions
+            return WhisperModel(
+                settings.WHISPER_CT2_MODEL_PATH or self.model_name,
+                device=self.device,
+                compute_type="int8_float16" if self.device == "cuda" else "int8",
+                cpu_threads=os.cpu_count() or 4
+            )
+        # The model stays resident (on the GPU when available) for the life of the
+        # service; half precision on GPU halves memory traffic per decoded token
+        return pipeline(
+            "automatic-speech-recognition",
+            model=self.model_name,
+            device=0 if self.device == "cuda" else -1,
+            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+            return_timestamps=True
+        )
+
+    def _transcribe_sync(self, model, audio: Union[str, np.ndarray]) -> str:
+        if self.backend == "faster-whisper":
+            # The VAD filter drops silence so the decoder runs on fewer frames
+            segments, _ = model.transcribe(audio, language="fa", beam_size=1, vad_filter=True)
+            return "".join(segment.text for segment in segments)
+        # Voice notes longer than 30s are cut into chunks that are decoded as one batch
+        with torch.inference_mode():
+            if isinstance(audio, np.ndarray):
+                audio = {"raw": audio, "sampling_rate": SAMPLE_RATE}
+            result = model(
+                audio,
+                chunk_length_s=30,
+                batch_size=8,
+                generate_kwargs={"language": "fa", "task": "transcribe"}
+            )
+        return result["text"]
+
+    def _transcribe_batch_sync(self, model, audios: List[np.ndarray]) -> List[str]:
+        with torch.inference_mode():
+            results = model(
+                [{"raw": audio, "sampling_rate": SAMPLE_RATE} for audio in audios],
+                chunk_length_s=30,
+                batch_size=settings.WHISPER_BATCH_SIZE,
+                generate_kwargs={"language": "fa", "task": "transcribe"}
+            )
+        return [result["text"] for result in results]
+
+    async def _batch_worker(self):
+        """
+        Collects voice notes that arrive within WHISPER_BATCH_WINDOW_MS of each other
+        (up to WHISPER_BATCH_SIZE) and transcribes them in one pipeline call, so
+        concurrent users share forward passes instead of queueing behind each other.
+        """
+        pipe = await self._get_pipeline()
+        loop = asyncio.get_running_loop()
+        window = settings.WHISPER_BATCH_WINDOW_MS / 1000
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + window
+            while len(batch) < settings.WHISPER_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                texts = await loop.run_in_executor(
+                    self._whisper_pool, self._transcribe_batch_sync, pipe, [audio for audio, _ in batch]
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            if len(batch) > 1:
+                logger.info(f"Transcribed a batch of {len(batch)} voice notes")
+            for (_, future), text in zip(batch, texts):
+                if not future.done():
+                    future.set_result(text)
+
+    async def _transcribe_batched(self, audio: np.ndarray) -> str:
+        # Load the model here, so a loading error reaches the caller instead of the worker
+        await self._get_pipeline()
+        if self._batch_worker_task is None or self._batch_worker_task.done():
+            self._queue = asyncio.Queue()
+            self._batch_worker_task = asyncio.create_task(self._batch_worker())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((audio, future))
+        return await future
+
+    async def download_voice_file(self, bot, file_id: str, voice_duration: int = None, voice_file_size: int = None) -> io.BytesIO:
         """
-        Download voice file from Telegram and save to temporary location.
+        Download voice file from Telegram into memory. Voice notes are a few MB at
+        most, so nothing is written to disk.
 
         Args:
             bot: Telegram bot instance
@@ -60,7 +184,7 @@ class SpeechService:
             voice_file_size: Size of voice file in bytes (for validation)
 
         Returns:
-            Path to downloaded file
+            In-memory buffer with the downloaded file, positioned at the start
 
         Raises:
             ValueError: If file is too large or too long
@@ -78,15 +202,13 @@ class SpeechService:
             # Get file info from Telegram
             file = await bot.get_file(file_id)
 
-            # Create temporary file
-            temp_dir = tempfile.mkdtemp()
-            temp_file_path = os.path.join(temp_dir, f"voice_{file_id}.ogg")
-
             # Download file
-            await bot.download_file(file.file_path, temp_file_path)
+            buffer = io.BytesIO()
+            await bot.download_file(file.file_path, destination=buffer)
+            buffer.seek(0)
 
-            logger.info(f"Voice file downloaded: {temp_file_path}")
-            return temp_file_path
+            logger.info(f"Voice file downloaded: {file_id} ({buffer.getbuffer().nbytes} bytes)")
+            return buffer
 
         except ValueError:
             # Re-raise validation errors
@@ -95,74 +217,87 @@ class SpeechService:
             logger.error(f"Error downloading voice file: {e}")
             raise
 
-    async def convert_audio_format(self, input_path: str) -> str:
+    async def decode_audio(self, source: Union[str, BinaryIO]) -> np.ndarray:
         """
-        Convert audio file to WAV format for Whisper processing.
+        Decode audio straight to a 16kHz mono float32 array for Whisper.
 
         Args:
-            input_path: Path to input audio file
+            source: Path to an audio file, or a file-like object with its contents
 
         Returns:
-            Path to converted WAV file
+            Audio samples in [-1, 1]
         """
         try:
-            # Generate output path
-            output_path = input_path.rsplit('.', 1)[0] + '.wav'
-
-            # Run conversion in executor to avoid blocking
+            # Run decoding in executor to avoid blocking
             loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                self._convert_audio_sync,
-                input_path,
-                output_path
-            )
+            audio = await loop.run_in_executor(self._audio_pool, self._decode_audio_sync, source)
 
-            logger.info(f"Audio converted to: {output_path}")
-            return output_path
+            logger.info(f"Audio decoded: {len(audio) / SAMPLE_RATE:.1f}s")
+            return audio
 
         except Exception as e:
-            logger.error(f"Error converting audio format: {e}")
+            logger.error(f"Error decoding audio: {e}")
             raise
 
-    def _convert_audio_sync(self, input_path: str, output_path: str):
+    def _decode_audio_sync(self, source: Union[str, BinaryIO]) -> np.ndarray:
         """
-        Synchronous audio conversion using pydub and librosa.
+        Synchronous in-memory decode with PyAV. libswresample downmixes and resamples
+        to 16kHz in the same pass, with no ffmpeg subprocess and no intermediate WAV.
         """
-        # Load audio with pydub (handles various formats)
-        audio = AudioSegment.from_file(input_path)
-
-        # Convert to mono and set sample rate to 16kHz (Whisper standard)
-        audio = audio.set_channels(1)
-        audio = audio.set_frame_rate(16000)
-
-        # Export as WAV
-        audio.export(output_path, format="wav")
-
-    async def transcribe_audio(self, audio_path: str) -> str:
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=SAMPLE_RATE)
+        chunks = []
+        with av.open(source, format=self._sniff_format(source)) as container:
+            for frame in container.decode(audio=0):
+                chunks.extend(out.to_ndarray() for out in resampler.resample(frame))
+            # Flush samples still buffered in the resampler
+            chunks.extend(out.to_ndarray() for out in resampler.resample(None))
+        if not chunks:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(chunks, axis=1).reshape(-1)
+
+    @staticmethod
+    def _sniff_format(source: Union[str, BinaryIO]) -> Optional[str]:
+        """
+        Telegram voice notes are Opus in an Ogg container. Recognising the Ogg magic
+        lets PyAV open the demuxer directly instead of probing the whole buffer;
+        anything else is left to ffmpeg's format detection.
+        """
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                magic = f.read(4)
+        else:
+            position = source.tell()
+            magic = source.read(4)
+            source.seek(position)
+        return "ogg" if magic == OGG_MAGIC else None
+
+    async def transcribe_audio(self, audio: Union[str, np.ndarray]) -> str:
         """
-        Transcribe audio file to Persian text using Whisper.
+        Transcribe audio to Persian text using Whisper.
 
         Args:
-            audio_path: Path to audio file
+            audio: Path to an audio file, or 16kHz mono samples from decode_audio
 
         Returns:
             Transcribed text in Persian
         """
         try:
-            # Get the pipeline
-            pipe = await self._get_pipeline()
-
-            # Run transcription in executor to avoid blocking
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                None,
-                pipe,
-                audio_path
-            )
-
-            # Extract text from result
-            text = result["text"].strip()
+            if self.backend == "transformers" and isinstance(audio, np.ndarray):
+                # Decoded samples go through the micro-batcher
+                text = await self._transcribe_batched(audio)
+            else:
+                # Get the pipeline
+                pipe = await self._get_pipeline()
+
+                # Run transcription in executor to avoid blocking
+                loop = asyncio.get_event_loop()
+                text = await loop.run_in_executor(
+                    self._whisper_pool,
+                    self._transcribe_sync,
+                    pipe,
+                    audio
+                )
+            text = text.strip()
 
             logger.info(f"Transcription completed. Length: {len(text)} characters")
             logger.debug(f"Transcribed text: {text[:100]}...")
@@ -186,18 +321,15 @@ class SpeechService:
         Returns:
             Transcribed Persian text
         """
-        temp_files = []
         try:
-            # Download voice file
-            voice_file_path = await self.download_voice_file(bot, file_id, voice_duration, voice_file_size)
-            temp_files.append(voice_file_path)
+            # Download voice file into memory
+            voice_file = await self.download_voice_file(bot, file_id, voice_duration, voice_file_size)
 
-            # Convert to WAV format
-            wav_file_path = await self.convert_audio_format(voice_file_path)
-            temp_files.append(wav_file_path)
+            # Decode to 16kHz samples in memory
+            audio = await self.decode_audio(voice_file)
 
             # Transcribe audio
-            transcribed_text = await self.transcribe_audio(wav_file_path)
+            transcribed_text = await self.transcribe_audio(audio)
 
             return transcribed_text
 
@@ -205,33 +337,24 @@ class SpeechService:
             logger.error(f"Error processing voice message: {e}")
             raise
 
-        finally:
-            # Clean up temporary files
-            for temp_file in temp_files:
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                        logger.debug(f"Cleaned up temp file: {temp_file}")
-                except Exception as e:
-                    logger.warning(f"Could not clean up temp file {temp_file}: {e}")
-
-            # Clean up temporary directories
-            for temp_file in temp_files:
-                try:
-                    temp_dir = os.path.dirname(temp_file)
-                    if os.path.exists(temp_dir) and not os.listdir(temp_dir):
-                        os.rmdir(temp_dir)
-                        logger.debug(f"Cleaned up temp directory: {temp_dir}")
-                except Exception as e:
-                    logger.warning(f"Could not clean up temp directory: {e}")
-
     def cleanup_model(self):
         """
         Clean up model resources.
         """
+        if self._batch_worker_task is not None:
+            self._batch_worker_task.cancel()
+            self._batch_worker_task = None
         if self._pipeline is not None:
             del self._pipeline
             self._pipeline = None
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
-            logger.info("Speech model cleaned up")
\ No newline at end of file
+            logger.info("Speech model cleaned up")
+
+    def close(self):
+        """
+        Release the model and shut down the audio and Whisper thread pools.
+        """
+        self.cleanup_model()
+        self._audio_pool.shutdown(wait=False, cancel_futures=True)
+        self._whisper_pool.shutdown(wait=False, cancel_futures=True)
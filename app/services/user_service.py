@@ -1,17 +1,203 @@
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
-from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy import Interval, bindparam, exists, insert, inspect, select, text, update
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql import func
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+import asyncio
+import hashlib
 import logging
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+
+from cachetools import TTLCache
 
 from models.schema import (
     User, UserProfile, Subscription, ContentHistory, SubscriptionStatus,
-    OnboardingStep, PromptHistory, DiscountCode
+    OnboardingStep, PromptHistory, PromptTemplate, DiscountCode
 )
 from core.config import settings
+from core.redis_client import get_redis
 
 logger = logging.getLogger(__name__)
 
+# In-progress onboarding steps live in Redis; only completion is written to the DB
+ONBOARDING_STEP_TTL_SECONDS = 24 * 60 * 60
+
+def _onboarding_key(user_id: int) -> str:
+    return f"onboarding:{user_id}"
+
+# Read statements used on every update are built once; per call only the bound
+# parameters change, and SQLAlchemy reuses the compiled form from its cache
+_SELECT_USER_WITH_RELATIONS = (
+    select(User)
+    .where(User.telegram_id == bindparam("telegram_id"))
+    .options(
+        joinedload(User.profile),
+        joinedload(User.subscription)
+    )
+)
+_SELECT_USER_BY_ID = select(User).where(User.id == bindparam("user_id"))
+_SELECT_PROFILE = select(UserProfile).where(UserProfile.user_id == bindparam("user_id"))
+_SELECT_SUBSCRIPTION = select(Subscription).where(Subscription.user_id == bindparam("user_id"))
+_SUBSCRIPTION_IS_ACTIVE = select(
+    exists().where(Subscription.user_id == bindparam("user_id"), Subscription.is_active)
+)
+_COUNT_CONTENT_SINCE = select(func.count(ContentHistory.id)).where(
+    ContentHistory.user_id == bindparam("user_id"),
+    ContentHistory.created_at >= func.now() - bindparam("period", type_=Interval)
+)
+
+# Column values of users by telegram_id, with their profile and subscription. A hit
+# is rebuilt into new objects and merged into the caller's session without a SELECT,
+# so no ORM state is shared between sessions. Entries are dropped when UserService
+# changes the user's rows; other processes may see changes up to the TTL late.
+_user_cache: TTLCache = TTLCache(maxsize=settings.USER_CACHE_MAX_ENTRIES, ttl=settings.USER_CACHE_TTL_SECONDS)
+# telegram_id of each cached user, to invalidate by user id
+_cached_telegram_ids: TTLCache = TTLCache(maxsize=settings.USER_CACHE_MAX_ENTRIES, ttl=settings.USER_CACHE_TTL_SECONDS)
+
+def _columns(obj) -> Optional[Dict[str, object]]:
+    if obj is None:
+        return None
+    return {attr.key: getattr(obj, attr.key) for attr in inspect(type(obj)).column_attrs}
+
+def _remember_user(user: User) -> None:
+    _user_cache[user.telegram_id] = {
+        "user": _columns(user),
+        "profile": _columns(user.profile),
+        "subscription": _columns(user.subscription)
+    }
+    _cached_telegram_ids[user.id] = user.telegram_id
+
+def _forget_user(user_id: int) -> None:
+    telegram_id = _cached_telegram_ids.pop(user_id, None)
+    if telegram_id is not None:
+        _user_cache.pop(telegram_id, None)
+
+def _rebuild_user(snapshot: Dict[str, Optional[Dict[str, object]]]) -> User:
+    """Detached User, profile and subscription built from a cache snapshot"""
+    user = User(**snapshot["user"])
+    user.profile = UserProfile(**snapshot["profile"]) if snapshot["profile"] else None
+    user.subscription = Subscription(**snapshot["subscription"]) if snapshot["subscription"] else None
+    # Marks the objects as already persisted, with no pending changes
+    for obj in (user, user.profile, user.subscription):
+        if obj is not None:
+            make_transient_to_detached(obj)
+    return user
+
+# prompt_templates ids by system prompt text. Templates are never changed once
+# stored, so after the first use a prompt's id is known without touching the row.
+_prompt_template_ids: Dict[str, int] = {}
+
+# Commits of data that may be lost in a crash (activity, history, analytics) return
+# without waiting for the WAL flush. Payments and subscriptions keep durable commits.
+_ASYNC_COMMIT = text("SET LOCAL synchronous_commit TO OFF")
+
+# Ids of users active since the last flush. Their last_activity is set to the
+# database's now() in one statement per interval, instead of one UPDATE and commit
+# per incoming message, so it is accurate to within the flush interval.
+_activity_buffer: Set[int] = set()
+
+async def flush_activity(session_pool: async_sessionmaker[AsyncSession]) -> None:
+    """Write last_activity of the buffered users with a single UPDATE"""
+    global _activity_buffer
+    if not _activity_buffer:
+        return
+    pending, _activity_buffer = _activity_buffer, set()
+    try:
+        async with session_pool() as session:
+            await session.execute(_ASYNC_COMMIT)
+            await session.execute(
+                update(User)
+                .where(User.id.in_(pending))
+                .values(last_activity=func.now())
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+    except Exception as e:
+        logger.error(f"Error flushing activity of {len(pending)} users: {e}")
+        # Retried with the next flush
+        _activity_buffer |= pending
+
+# Generated content waiting to be inserted into content_history in one batch. The
+# buffer is capped so a database outage cannot grow it without bound; past the cap
+# the oldest rows are dropped.
+_HISTORY_BUFFER_MAX_ROWS = 5000
+# Failed batch inserts after which the rows are inserted one by one, and the ones
+# that still fail are discarded
+_HISTORY_MAX_BATCH_FAILURES = 3
+_history_buffer: List[dict] = []
+_history_batch_failures = 0
+
+def _buffer_history(rows: List[dict]) -> None:
+    """Append rows to the history buffer, dropping the oldest ones beyond the cap"""
+    _history_buffer.extend(rows)
+    overflow = len(_history_buffer) - _HISTORY_BUFFER_MAX_ROWS
+    if overflow > 0:
+        del _history_buffer[:overflow]
+        logger.warning(f"Content history buffer full, dropped {overflow} oldest rows")
+
+async def _insert_history_rows_singly(session_pool: async_sessionmaker[AsyncSession], rows: List[dict]) -> None:
+    """Insert rows one by one, each in a savepoint, discarding the rows that fail"""
+    lost = 0
+    try:
+        async with session_pool() as session:
+            await session.execute(_ASYNC_COMMIT)
+            for row in rows:
+                try:
+                    async with session.begin_nested():
+                        await session.execute(insert(ContentHistory), [row])
+                except Exception as e:
+                    lost += 1
+                    logger.error(f"Discarding content history row of user {row['user_id']}: {e}")
+            await session.commit()
+    except Exception as e:
+        lost = len(rows)
+        logger.error(f"Discarding {lost} content history rows: {e}")
+    if lost:
+        logger.error(f"Content history flush lost {lost} of {len(rows)} rows")
+
+async def flush_content_history(session_pool: async_sessionmaker[AsyncSession]) -> None:
+    """Insert the buffered content history rows with a single executemany INSERT"""
+    global _history_buffer, _history_batch_failures
+    if not _history_buffer:
+        return
+    pending, _history_buffer = _history_buffer, []
+    try:
+        async with session_pool() as session:
+            await session.execute(_ASYNC_COMMIT)
+            await session.execute(insert(ContentHistory), pending)
+            await session.commit()
+        _history_batch_failures = 0
+    except Exception as e:
+        _history_batch_failures += 1
+        logger.error(
+            f"Error flushing {len(pending)} content history rows "
+            f"(attempt {_history_batch_failures}/{_HISTORY_MAX_BATCH_FAILURES}): {e}"
+        )
+        if _history_batch_failures < _HISTORY_MAX_BATCH_FAILURES:
+            # Retried with the next batch, ahead of rows buffered since
+            newer, _history_buffer = _history_buffer, pending
+            _buffer_history(newer)
+        else:
+            # A single bad row (e.g. a deleted user) must not block every later batch
+            _history_batch_failures = 0
+            await _insert_history_rows_singly(session_pool, pending)
+
+async def run_flusher(
+    flush: Callable[[async_sessionmaker[AsyncSession]], Awaitable[None]],
+    session_pool: async_sessionmaker[AsyncSession],
+    interval: float
+) -> None:
+    """Background task calling a buffer's flush every interval; flushes once more when cancelled"""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await flush(session_pool)
+    finally:
+        await flush(session_pool)
+
 class UserService:
     def __init__(self, db_session: AsyncSession):
         self.db = db_session
@@ -19,61 +205,56 @@ class UserService:
     async def get_or_create_user(self, telegram_id: int, **kwargs) -> User:
         """Get existing user or create new one"""
         # Check if user exists
-        stmt = select(User).where(User.telegram_id == telegram_id)
-        result = await self.db.execute(stmt)
-        user = result.scalar_one_or_none()
+        user = await self.get_user_with_relations(telegram_id)
         
         if user:
-            # Update last activity
-            user.last_activity = datetime.now(timezone.utc)
-            await self.db.commit()
+            # Buffered and written by the activity flusher, not committed per message
+            _activity_buffer.add(user.id)
             return user
         
         # Create new user
         user = User(telegram_id=telegram_id, **kwargs)
         user.generate_referral_code()
+
+        # Attach profile and trial subscription through the relationships so
+        # they are populated on the returned user without another SELECT
+        user.profile = UserProfile()
+        user.subscription = Subscription.create_trial(trial_days=settings.TRIAL_DAYS)
         self.db.add(user)
-        await self.db.flush()  # Get user.id
-        
-        # Create user profile
-        profile = UserProfile(user_id=user.id)
-        self.db.add(profile)
-        
-        # Create trial subscription
-        subscription = Subscription.create_trial(user.id, settings.TRIAL_DAYS)
-        self.db.add(subscription)
-
-        # Handle referral code if provided
-        referred_by_code = getattr(user, "referred_by_code", None)
-        if referred_by_code:
-            ref_stmt = select(User).where(User.referral_code == referred_by_code)
-            ref_res = await self.db.execute(ref_stmt)
-            ref_user = ref_res.scalar_one_or_none()
-            if ref_user:
-                ref_user.referral_count = (ref_user.referral_count or 0) + 1
-        
+
+        # Credit the referrer in the same transaction, with one UPDATE instead of
+        # loading the referring user first
+        referrer_ids = []
+        if user.referred_by_code:
+            ref_stmt = (
+                update(User)
+                .where(User.referral_code == user.referred_by_code)
+                .values(referral_count=func.coalesce(User.referral_count, 0) + 1)
+                .returning(User.id)
+            )
+            referrer_ids = (await self.db.execute(ref_stmt)).scalars().all()
+
+        # The user, profile and subscription INSERTs are flushed and committed together;
+        # eager_defaults loads their server-side defaults from RETURNING, so no refresh
         await self.db.commit()
-        await self.db.refresh(user)
+        for referrer_id in referrer_ids:
+            _forget_user(referrer_id)
         return user
     
     async def get_user_with_relations(self, telegram_id: int) -> Optional[User]:
-        """Get user with profile and subscription"""
-        stmt = (
-            select(User)
-            .where(User.telegram_id == telegram_id)
-            .options(
-                # selectinload(User.profile),
-                # selectinload(User.subscription)
-            )
-        )
-        result = await self.db.execute(stmt)
-        return result.scalar_one_or_none()
+        """Get user with profile and subscription in a single query, or from the user cache"""
+        snapshot = _user_cache.get(telegram_id)
+        if snapshot is not None:
+            return await self.db.merge(_rebuild_user(snapshot), load=False)
+        result = await self.db.execute(_SELECT_USER_WITH_RELATIONS, {"telegram_id": telegram_id})
+        user = result.unique().scalar_one_or_none()
+        if user is not None:
+            _remember_user(user)
+        return user
 
     async def get_user_by_telegram_id(self, telegram_id: int) -> Optional[User]:
         """Get user by telegram id"""
-        stmt = select(User).where(User.telegram_id == telegram_id)
-        result = await self.db.execute(stmt)
-        return result.scalar_one_or_none()
+        return await self.get_user_with_relations(telegram_id)
     
     async def update_user_profile(
         self,
@@ -89,6 +270,7 @@ class UserService:
             )
             await self.db.execute(stmt)
             await self.db.commit()
+            _forget_user(user_id)
             return True
         except Exception as e:
             logger.error(f"Error updating user profile {user_id}: {e}")
@@ -97,91 +279,45 @@ class UserService:
     
     async def get_user_profile(self, user_id: int) -> Optional[UserProfile]:
         """Get user profile"""
-        stmt = select(UserProfile).where(UserProfile.user_id == user_id)
-        result = await self.db.execute(stmt)
+        result = await self.db.execute(_SELECT_PROFILE, {"user_id": user_id})
         return result.scalar_one_or_none()
 
     async def update_profile_summary_and_complete(self, user_id: int, summary: str, approved: bool) -> bool:
         """Save summary and optionally mark onboarding completed"""
-        try:
-            logger.info(f"Starting to update profile summary for user {user_id}")
-            logger.info(f"Database session type: {type(self.db)}")
-            logger.info(f"Database session state: {self.db.is_active if hasattr(self.db, 'is_active') else 'Unknown'}")
-            
-            # Save summary
-            stmt = (
-                update(UserProfile)
-                .where(UserProfile.user_id == user_id)
-                .values({
-                    UserProfile.situation_summary: summary,
-                    UserProfile.summary_approved: approved
-                })
-            )
-            logger.info("Executing profile update statement...")
-            await self.db.execute(stmt)
-            
-            # Mark user onboarding completed
-            if approved:
-                logger.info("Marking user onboarding as completed...")
-                user_stmt = (
-                    update(User)
-                    .where(User.id == user_id)
-                    .values(onboarding_completed=True)
-                )
-                await self.db.execute(user_stmt)
-            
-            logger.info("Committing changes...")
-            await self.db.commit()
-            logger.info("Profile summary update completed successfully")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error saving profile summary for user {user_id}: {e}")
-            logger.error(f"Error type: {type(e)}")
-            logger.error(f"Error details: {str(e)}")
-            try:
-                await self.db.rollback()
-            except Exception as rollback_error:
-                logger.error(f"Error during rollback: {rollback_error}")
-            return False
+        return await self._save_summary(
+            user_id, approved, situation_summary=summary, summary_approved=approved
+        )
 
     async def approved_profile_summary(self, user_id: int, approved: bool) -> bool:
         """Approved summary and optionally mark onboarding completed"""
+        return await self._save_summary(user_id, approved, summary_approved=approved)
+
+    async def _save_summary(self, user_id: int, approved: bool, **profile_values) -> bool:
+        """
+        Update the profile and, once approved, complete onboarding in the same statement:
+        the profile UPDATE runs as a writable CTE that the users UPDATE selects from.
+        """
         try:
-            logger.info(f"Starting to update profile summary for user {user_id}")
-            logger.info(f"Database session type: {type(self.db)}")
-            logger.info(f"Database session state: {self.db.is_active if hasattr(self.db, 'is_active') else 'Unknown'}")
-            
-            # approved summary
             stmt = (
                 update(UserProfile)
                 .where(UserProfile.user_id == user_id)
-                .values({
-                    UserProfile.summary_approved: approved
-                })
+                .values(**profile_values)
             )
-            logger.info("Executing profile update statement...")
-            await self.db.execute(stmt)
-            
-            # Mark user onboarding completed
             if approved:
-                logger.info("Marking user onboarding as completed...")
-                user_stmt = (
+                profile = stmt.returning(UserProfile.user_id).cte("profile")
+                stmt = (
                     update(User)
-                    .where(User.id == user_id)
-                    .values(onboarding_completed=True)
+                    .where(User.id.in_(select(profile.c.user_id)))
+                    .values(onboarding_completed=True, onboarding_step=OnboardingStep.COMPLETED)
                 )
-                await self.db.execute(user_stmt)
-            
-            logger.info("Committing changes...")
+            await self.db.execute(stmt)
             await self.db.commit()
-            logger.info("Profile summary update completed successfully")
+            _forget_user(user_id)
+            if approved:
+                await self._clear_onboarding_step(user_id)
             return True
-            
         except Exception as e:
             logger.error(f"Error saving profile summary for user {user_id}: {e}")
-            logger.error(f"Error type: {type(e)}")
-            logger.error(f"Error details: {str(e)}")
             try:
                 await self.db.rollback()
             except Exception as rollback_error:
@@ -189,51 +325,76 @@ class UserService:
             return False
 
     async def update_onboarding_step(self, user_id: int, step: OnboardingStep) -> bool:
-        """Update user's onboarding step"""
+        """Update user's onboarding step, in Redis when available and otherwise in the DB"""
+        redis = get_redis()
+        if redis is not None:
+            try:
+                await redis.set(_onboarding_key(user_id), step.value, ex=ONBOARDING_STEP_TTL_SECONDS)
+                return True
+            except Exception as e:
+                logger.warning(f"Redis unavailable for onboarding step of user {user_id}, using DB: {e}")
         try:
             stmt = (
                 update(User)
                 .where(User.id == user_id)
                 .values(onboarding_step=step)
             )
+            await self.db.execute(_ASYNC_COMMIT)
             await self.db.execute(stmt)
             await self.db.commit()
+            _forget_user(user_id)
             return True
         except Exception as e:
             logger.error(f"Error updating onboarding step for user {user_id}: {e}")
             await self.db.rollback()
             return False
 
-    async def update_user_display_name(self, user_id: int, display_name: str) -> bool:
+    async def _clear_onboarding_step(self, user_id: int) -> None:
+        """Drop the cached onboarding step once onboarding is persisted as completed"""
+        redis = get_redis()
+        if redis is None:
+            return
         try:
-            stmt = update(User).where(User.id == user_id).values(display_name=display_name)
-            await self.db.execute(stmt)
-            await self.db.commit()
-            return True
+            await redis.delete(_onboarding_key(user_id))
         except Exception as e:
-            logger.error(f"Error updating display name for user {user_id}: {e}")
-            await self.db.rollback()
-            return False
+            logger.warning(f"Could not clear onboarding step for user {user_id}: {e}")
 
-    async def update_user_phone(self, user_id: int, phone: str) -> bool:
+    async def update_user_fields(self, user_id: int, **fields) -> bool:
+        """Update any number of user columns with one UPDATE"""
         try:
-            stmt = update(User).where(User.id == user_id).values(phone=phone)
+            stmt = update(User).where(User.id == user_id).values(**fields)
             await self.db.execute(stmt)
             await self.db.commit()
+            _forget_user(user_id)
             return True
         except Exception as e:
-            logger.error(f"Error updating phone for user {user_id}: {e}")
+            logger.error(f"Error updating {', '.join(fields)} for user {user_id}: {e}")
             await self.db.rollback()
             return False
 
+    async def update_user_display_name(self, user_id: int, display_name: str) -> bool:
+        return await self.update_user_fields(user_id, display_name=display_name)
+
+    async def update_user_phone(self, user_id: int, phone: str) -> bool:
+        return await self.update_user_fields(user_id, phone=phone)
+
     async def update_user_email(self, user_id: int, email: str) -> bool:
+        return await self.update_user_fields(user_id, email=email)
+
+    async def save_onboarding_answers(self, user_id: int, user_fields: dict, profile_fields: dict) -> bool:
+        """Write the answers collected during onboarding: one UPDATE per table, one commit"""
         try:
-            stmt = update(User).where(User.id == user_id).values(email=email)
-            await self.db.execute(stmt)
+            if user_fields:
+                await self.db.execute(update(User).where(User.id == user_id).values(**user_fields))
+            if profile_fields:
+                await self.db.execute(
+                    update(UserProfile).where(UserProfile.user_id == user_id).values(**profile_fields)
+                )
             await self.db.commit()
+            _forget_user(user_id)
             return True
         except Exception as e:
-            logger.error(f"Error updating email for user {user_id}: {e}")
+            logger.error(f"Error saving onboarding answers for user {user_id}: {e}")
             await self.db.rollback()
             return False
 
@@ -263,14 +424,14 @@ class UserService:
     
     async def get_user_subscription(self, user_id: int) -> Optional[Subscription]:
         """Get user subscription"""
-        stmt = select(Subscription).where(Subscription.user_id == user_id)
-        result = await self.db.execute(stmt)
+        result = await self.db.execute(_SELECT_SUBSCRIPTION, {"user_id": user_id})
         return result.scalar_one_or_none()
     
     async def is_user_subscribed(self, user_id: int) -> bool:
         """Check if user has active subscription"""
-        subscription = await self.get_user_subscription(user_id)
-        return subscription.is_active if subscription else False
+        # Decided in SQL; only a boolean comes back, not the subscription row
+        result = await self.db.execute(_SUBSCRIPTION_IS_ACTIVE, {"user_id": user_id})
+        return bool(result.scalar())
     
     async def save_content_history(
         self,
@@ -279,47 +440,69 @@ class UserService:
         prompt: str,
         generated_content: str
     ) -> bool:
-        """Save generated content to history"""
-        try:
-            history = ContentHistory(
-                user_id=user_id,
-                content_type=content_type,
-                prompt=prompt,
-                generated_content=generated_content
-            )
-            self.db.add(history)
-            await self.db.commit()
-            return True
-        except Exception as e:
-            logger.error(f"Error saving content history for user {user_id}: {e}")
-            await self.db.rollback()
-            return False
+        """Queue generated content for the next batched history insert"""
+        _buffer_history([{
+            "user_id": user_id,
+            "content_type": content_type,
+            "prompt": prompt,
+            "generated_content": generated_content,
+            # Time of generation, not of the flush
+            "created_at": datetime.now(timezone.utc)
+        }])
+        return True
 
     async def save_prompt_usage(
         self,
         user_id: int,
         prompt_name: str,
-        prompt_content: str
+        prompt_content: str,
+        system_prompt: Optional[str] = None
     ) -> bool:
-        """Insert or increment prompt usage for analytics"""
+        """
+        Insert or increment prompt usage for analytics. prompt_content is the user's own
+        part of the prompt and stays on their row; the static system prompt is stored once
+        in prompt_templates, keyed by its digest, and referenced by id.
+        """
         try:
-            stmt = select(PromptHistory).where(
-                PromptHistory.user_id == user_id,
-                PromptHistory.prompt_name == prompt_name
+            await self.db.execute(_ASYNC_COMMIT)
+            template_id = None
+            if system_prompt is not None:
+                template_id = _prompt_template_ids.get(system_prompt)
+                if template_id is None:
+                    # Only on a prompt's first use in this process; the no-op update
+                    # makes RETURNING give the id of an existing row too
+                    template_stmt = pg_insert(PromptTemplate).values(
+                        digest=hashlib.sha256(system_prompt.encode()).hexdigest(),
+                        name=prompt_name,
+                        content=system_prompt
+                    )
+                    template_stmt = template_stmt.on_conflict_do_update(
+                        index_elements=[PromptTemplate.digest],
+                        set_={"digest": template_stmt.excluded.digest}
+                    ).returning(PromptTemplate.id)
+                    template_id = (await self.db.execute(template_stmt)).scalar_one()
+
+            stmt = pg_insert(PromptHistory).values(
+                user_id=user_id,
+                prompt_name=prompt_name,
+                prompt_content=prompt_content,
+                prompt_template_id=template_id,
+                usage_count=1
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[PromptHistory.user_id, PromptHistory.prompt_name],
+                set_={
+                    "usage_count": PromptHistory.usage_count + 1,
+                    "prompt_content": stmt.excluded.prompt_content,
+                    "prompt_template_id": stmt.excluded.prompt_template_id,
+                    "updated_at": func.now()
+                }
             )
-            result = await self.db.execute(stmt)
-            existing = result.scalar_one_or_none()
-            if existing:
-                existing.usage_count += 1
-                existing.prompt_content = prompt_content
-            else:
-                self.db.add(PromptHistory(
-                    user_id=user_id,
-                    prompt_name=prompt_name,
-                    prompt_content=prompt_content,
-                    usage_count=1
-                ))
+            await self.db.execute(stmt)
             await self.db.commit()
+            # Remembered only once committed, so a rolled-back insert is never referenced
+            if template_id is not None:
+                _prompt_template_ids[system_prompt] = template_id
             return True
         except Exception as e:
             logger.error(f"Error saving prompt usage for user {user_id}: {e}")
@@ -329,12 +512,19 @@ class UserService:
     async def apply_discount_code(self, code: str, user_id: int) -> Optional[DiscountCode]:
         """Validate and mark discount usage if valid"""
         try:
-            stmt = select(DiscountCode).where(DiscountCode.code == code)
-            result = await self.db.execute(stmt)
-            discount = result.scalar_one_or_none()
-            if not discount or not discount.is_valid:
+            # Validity is checked and the use counted in one atomic UPDATE, so
+            # concurrent redemptions cannot exceed max_uses
+            stmt = (
+                update(DiscountCode)
+                .where(DiscountCode.code == code, DiscountCode.is_valid)
+                .values(current_uses=DiscountCode.current_uses + 1)
+                .returning(DiscountCode)
+                # The returned row overwrites any DiscountCode already in the session
+                .execution_options(synchronize_session=False, populate_existing=True)
+            )
+            discount = (await self.db.execute(stmt)).scalar_one_or_none()
+            if not discount:
                 return None
-            discount.current_uses += 1
             await self.db.commit()
             return discount
         except Exception as e:
@@ -351,39 +541,71 @@ class UserService:
     ) -> bool:
         """Extend user subscription"""
         try:
-            from datetime import timedelta
-            
-            subscription = await self.get_user_subscription(user_id)
-            if not subscription:
+            # Extend from current expiry or now, whichever is later, computed in the
+            # UPDATE itself so concurrent payments both count
+            stmt = (
+                update(Subscription)
+                .where(Subscription.user_id == user_id)
+                .values(
+                    expires_at=func.greatest(Subscription.expires_at, func.now()) + timedelta(days=30 * months),
+                    status=SubscriptionStatus.ACTIVE,
+                    payment_amount=payment_amount,
+                    payment_reference=payment_reference,
+                    updated_at=func.now()
+                )
+                .returning(
+                    Subscription.id, Subscription.expires_at, Subscription.status,
+                    Subscription.payment_amount, Subscription.payment_reference, Subscription.updated_at
+                )
+                .execution_options(synchronize_session=False)
+            )
+            row = (await self.db.execute(stmt)).first()
+            if row is None:
                 return False
-            
-            # Extend from current expiry or now, whichever is later
-            extend_from = max(subscription.expires_at, datetime.now(timezone.utc))
-            new_expiry = extend_from + timedelta(days=30 * months)
-            
-            subscription.expires_at = new_expiry
-            subscription.status = SubscriptionStatus.ACTIVE
-            subscription.payment_amount = payment_amount
-            subscription.payment_reference = payment_reference
-            subscription.updated_at = datetime.now(timezone.utc)
-            
+            self._sync_subscription(row)
+
             await self.db.commit()
+            _forget_user(user_id)
             return True
         except Exception as e:
             logger.error(f"Error extending subscription for user {user_id}: {e}")
             await self.db.rollback()
             return False
 
+    def _sync_subscription(self, row) -> None:
+        """
+        Copy the RETURNING values of a subscription UPDATE onto the Subscription already
+        loaded in this session, if any. SQL-computed values such as greatest(...) cannot
+        be evaluated in Python, and expiring them would make the next read lazy-load.
+        """
+        subscription = self.db.identity_map.get(identity_key(Subscription, row.id))
+        if subscription is not None:
+            for key, value in row._mapping.items():
+                set_committed_value(subscription, key, value)
+
     async def update_subscription_discount(self, user_id: int, code: DiscountCode) -> bool:
         """Attach discount to user's subscription"""
         try:
-            subscription = await self.get_user_subscription(user_id)
-            if not subscription:
+            stmt = (
+                update(Subscription)
+                .where(Subscription.user_id == user_id)
+                .values(
+                    discount_applied=code.discount_percentage,
+                    discount_code=code.code,
+                    updated_at=func.now()
+                )
+                .returning(
+                    Subscription.id, Subscription.discount_applied,
+                    Subscription.discount_code, Subscription.updated_at
+                )
+                .execution_options(synchronize_session=False)
+            )
+            row = (await self.db.execute(stmt)).first()
+            if row is None:
                 return False
-            subscription.discount_applied = code.discount_percentage
-            subscription.discount_code = code.code
-            subscription.updated_at = datetime.now(timezone.utc)
+            self._sync_subscription(row)
             await self.db.commit()
+            _forget_user(user_id)
             return True
         except Exception as e:
             logger.error(f"Error updating subscription discount for user {user_id}: {e}")
@@ -392,24 +614,18 @@ class UserService:
 
     async def ensure_referral_code(self, user_id: int) -> Optional[str]:
         """Ensure user has a referral code and return it"""
-        stmt = select(User).where(User.id == user_id)
-        result = await self.db.execute(stmt)
+        result = await self.db.execute(_SELECT_USER_BY_ID, {"user_id": user_id})
         user = result.scalar_one_or_none()
         if not user:
             return None
         if not user.referral_code:
             user.generate_referral_code()
             await self.db.commit()
+            _forget_user(user_id)
         return user.referral_code
     
     async def get_user_content_count(self, user_id: int, days: int = 30) -> int:
         """Get user's content generation count in last N days"""
-        from datetime import timedelta
-        
-        cutoff_date = datetime.now(timezone.utc) - timedelta(days=days)
-        stmt = select(ContentHistory).where(
-            ContentHistory.user_id == user_id,
-            ContentHistory.created_at >= cutoff_date
-        )
-        result = await self.db.execute(stmt)
-        return len(result.scalars().all())
\ No newline at end of file
+        # Counted in the database; only the number comes back, not the rows
+        result = await self.db.execute(_COUNT_CONTENT_SINCE, {"user_id": user_id, "period": timedelta(days=days)})
+        return result.scalar_one()
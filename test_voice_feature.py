@@ -4,6 +4,21 @@ Test script for the Persian speech-to-text feature implementation.
 This script verifies that all files are properly structured and ready for testing.
 """
 
+def find_tokens(path, tokens):
+    """Return which tokens occur in a file, searched through a read-only memory map."""
+    import mmap
+    import os
+    import re
+
+    # mmap cannot map an empty file
+    if os.stat(path).st_size == 0:
+        return {token: False for token in tokens}
+    # One alternation finds every token in a single pass over the file
+    pattern = re.compile(b'|'.join(re.escape(token.encode()) for token in tokens))
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        found = set(pattern.findall(mm))
+    return {token: token.encode() in found for token in tokens}
+
 def test_file_structure():
     """Test that all required files exist and are properly structured."""
     import os
@@ -11,25 +26,22 @@ def test_file_structure():
     print("🔍 Testing file structure...")
 
     # Check requirements.txt
-    with open('requirements.txt', 'r') as f:
-        requirements = f.read()
-        speech_deps = ['torch', 'transformers', 'librosa', 'pydub', 'soundfile']
-        for dep in speech_deps:
-            if dep in requirements:
-                print(f"✅ {dep} found in requirements.txt")
-            else:
-                print(f"❌ {dep} missing from requirements.txt")
+    speech_deps = ['torch', 'transformers', 'librosa', 'pydub', 'soundfile']
+    for dep, found in find_tokens('requirements.txt', speech_deps).items():
+        if found:
+            print(f"✅ {dep} found in requirements.txt")
+        else:
+            print(f"❌ {dep} missing from requirements.txt")
 
     # Check speech service
     speech_service_path = 'app/services/speech_service.py'
     if os.path.exists(speech_service_path):
         print(f"✅ {speech_service_path} exists")
-        with open(speech_service_path, 'r') as f:
-            content = f.read()
-            if 'vhdm/whisper-large-fa-v1' in content:
-                print("✅ Persian Whisper model configured")
-            if 'async def process_voice_message' in content:
-                print("✅ Voice processing method implemented")
+        found = find_tokens(speech_service_path, ['vhdm/whisper-large-fa-v1', 'async def process_voice_message'])
+        if found['vhdm/whisper-large-fa-v1']:
+            print("✅ Persian Whisper model configured")
+        if found['async def process_voice_message']:
+            print("✅ Voice processing method implemented")
     else:
         print(f"❌ {speech_service_path} missing")
 
@@ -37,14 +49,13 @@ def test_file_structure():
     handler_path = 'app/handlers/common.py'
     if os.path.exists(handler_path):
         print(f"✅ {handler_path} exists")
-        with open(handler_path, 'r') as f:
-            content = f.read()
-            if '@router.message(F.voice)' in content:
-                print("✅ Voice message handler added")
-            if 'SpeechService' in content:
-                print("✅ SpeechService imported")
-            if 'قابلیت جدید - پیام صوتی' in content:
-                print("✅ Help text updated with voice feature")
+        found = find_tokens(handler_path, ['@router.message(F.voice)', 'SpeechService', 'قابلیت جدید - پیام صوتی'])
+        if found['@router.message(F.voice)']:
+            print("✅ Voice message handler added")
+        if found['SpeechService']:
+            print("✅ SpeechService imported")
+        if found['قابلیت جدید - پیام صوتی']:
+            print("✅ Help text updated with voice feature")
     else:
         print(f"❌ {handler_path} missing")
 
@@ -52,10 +63,8 @@ def test_file_structure():
     config_path = 'app/core/config.py'
     if os.path.exists(config_path):
         print(f"✅ {config_path} exists")
-        with open(config_path, 'r') as f:
-            content = f.read()
-            if 'WHISPER_MODEL_NAME' in content:
-                print("✅ Speech configuration added")
+        if find_tokens(config_path, ['WHISPER_MODEL_NAME'])['WHISPER_MODEL_NAME']:
+            print("✅ Speech configuration added")
     else:
         print(f"❌ {config_path} missing")
 